@@ -1,8 +1,27 @@
 import sys
 import copy
+import random
 
 import move
 
+# Zobrist keys for hashing boards. ZOBRIST_KEYS[row][column] is a random
+# 64 bit number for a block at that cell, and the hash of a board is all the
+# keys of its blocks xored together.
+# Rows of keys are made when they are first needed, each from a seed of its
+# row number, so every process makes the same keys whatever order it needs
+# them in.
+ZOBRIST_KEYS = []
+
+def get_zobrist_keys(row, width):
+    while len(ZOBRIST_KEYS) <= row:
+        ZOBRIST_KEYS.append(())
+    keys = ZOBRIST_KEYS[row]
+    if len(keys) < width:
+        r = random.Random(row)
+        keys = tuple(r.getrandbits(64) for i in range(0, max(width, 16)))
+        ZOBRIST_KEYS[row] = keys
+    return keys
+
 # Defines the tetris game environment.
 # Stores the game board using _grid, which contains a 2d list.
 # Rows and columns can be accessed like this _grid[row][column]
@@ -13,11 +32,23 @@ import move
 # Consequently an empty grid will have 0 rows, and a grid with only an
 # O block (square block) will have 2 rows
 # The function place_block will generate new rows when needed
+# _heights stores the skyline of the board, the height of each column,
+# which is one more than the row of the highest block in the column.
+# _num_blocks counts the blocks on the board, so the number of empty cells
+# is known without looking at the grid.
+# _hash is the Zobrist hash of the board, and _mirror_hash the hash the
+# board would have if it were flipped left to right. Both are kept up to
+# date as blocks are placed and removed.
 class Board:
     def __init__(self, width):
         self._width = width
         self._grid = []
+        self._heights = [0] * width
+        self._num_blocks = 0
         self._rows_cleared = 0
+        self._full_row = (1 << width) - 1
+        self._hash = 0
+        self._mirror_hash = 0
 
     def copy(self):
         return copy.deepcopy(self)
@@ -30,14 +61,68 @@ class Board:
         
     def get_rows_cleared(self):
         return self._rows_cleared
+
+    def get_column_height(self, column):
+        return self._heights[column]
+
+    def get_heights(self):
+        return list(self._heights)
+
+    # Returns the row as an integer bitmask, bit n being set if there is a
+    # block in column n. Rows above the grid are empty.
+    def get_row_mask(self, row):
+        if row >= len(self._grid):
+            return 0
+        mask = 0
+        for column in range(0, self._width):
+            if self._grid[row][column]:
+                mask |= 1 << column
+        return mask
       
+    def get_num_blocks(self):
+        return self._num_blocks
+
     def get_num_holes(self):
-        n = 0
-        for row in reversed(self._grid):
-            for column in row:
-                if not column:
-                    n += 1
-        return n
+        return len(self._grid) * self._width - self._num_blocks
+
+    def get_hash(self):
+        return self._hash
+
+    # Returns the same hash for a board and its mirror image
+    def get_canonical_hash(self):
+        return min(self._hash, self._mirror_hash)
+
+    # Returns the canonical hash the board would have with blocks added at
+    # the given (row, column) cells, such as those get_placement returns.
+    # Only right if no rows would be filled, as the rows above them would
+    # move down.
+    def get_canonical_hash_with(self, cells):
+        width = self._width
+        h = self._hash
+        mirror = self._mirror_hash
+        for row, column in cells:
+            keys = get_zobrist_keys(row, width)
+            h ^= keys[column]
+            mirror ^= keys[width - 1 - column]
+        return min(h, mirror)
+
+    # Adds or removes a block at the indicated row and column from the hashes
+    def toggle_hash(self, row, column):
+        keys = get_zobrist_keys(row, self._width)
+        self._hash ^= keys[column]
+        self._mirror_hash ^= keys[self._width - 1 - column]
+
+    # Adds or removes every block from the given row up from the hashes.
+    # Used around removing full lines, as the rows above them move down.
+    def toggle_hash_from(self, first):
+        for row in range(first, len(self._grid)):
+            mask = self.get_row_mask(row)
+            column = 0
+            while mask:
+                if mask & 1:
+                    self.toggle_hash(row, column)
+                mask >>= 1
+                column += 1
 
     # Places a block at the indicated row and column
     # Will generate new rows if needed
@@ -54,6 +139,10 @@ class Board:
             raise Exception("block already at position")
         
         self._grid[row][column] = True
+        self._num_blocks += 1
+        self.toggle_hash(row, column)
+        if row >= self._heights[column]:
+            self._heights[column] = row + 1
 
     def block_at(self, row, column):
         if column >= self._width:
@@ -75,14 +164,40 @@ class Board:
     def append_row(self):
         self._grid.append([False]*self._width)
 
-    def remove_full_lines(self):
+    # Removes the full lines between rows first and last (inclusive), or
+    # from the whole grid if they are not given.
+    # Returns a list of (row, line) pairs of the lines that were removed,
+    # lowest row first, so that they can be put back by undo_move.
+    def remove_full_lines(self, first=0, last=None):
+        if last is None or last >= len(self._grid):
+            last = len(self._grid) - 1
         full_lines = []
-        for i in range(0, len(self._grid)):
+        for i in range(first, last + 1):
             if all(self._grid[i]):
                 full_lines.append(i)
+        if full_lines:
+            self.toggle_hash_from(full_lines[0])
+        removed = []
         for line in reversed(full_lines):
-            self._grid.pop(line)
+            removed.append((line, self._grid.pop(line)))
             self._rows_cleared += 1
+        self._num_blocks -= len(full_lines) * self._width
+        if full_lines:
+            self.toggle_hash_from(full_lines[0])
+            self.update_heights(len(full_lines))
+        removed.reverse()
+        return removed
+
+    # Updates the skyline after n full lines have been removed.
+    # Every column had a block in each of the removed lines, so each column
+    # is at least n shorter, and only needs scanning down past that when its
+    # highest block was in a removed line.
+    def update_heights(self, n):
+        for column in range(0, self._width):
+            height = self._heights[column] - n
+            while height > 0 and not self.block_at(height - 1, column):
+                height -= 1
+            self._heights[column] = height
 
     # Checks if the piece can be placed on the board with its column.
     # Changes the column to a valid one if it can.
@@ -111,25 +226,81 @@ class Board:
 
     # Helper function for apply_move
     def place_piece_at_row(self, move, board_row):
-        for row in range(0, move.get_height()):
-            for column in range (0, move.get_width()):
-                if move.block_at(row, column):
-                    self.place_block(board_row + row,
-                                     move.get_column() + column)
+        column = move.get_column()
+        for cell in move.get_shape().cells:
+            self.place_block(board_row + cell[0], column + cell[1])
+
+    # Helper function for undo_move, the reverse of place_piece_at_row.
+    # Does not remove rows or update the skyline.
+    def remove_piece_at_row(self, move, board_row):
+        column = move.get_column()
+        cells = move.get_shape().cells
+        for cell in cells:
+            self._grid[board_row + cell[0]][column + cell[1]] = False
+            self.toggle_hash(board_row + cell[0], column + cell[1])
+        self._num_blocks -= len(cells)
 
+    # Returns the row the bottom of the piece comes to rest on when dropped.
+    # Each column of the piece lands on the skyline of the board, so the
+    # piece rests on whichever column is the first to touch.
+    def get_landing_row(self, move):
+        heights = self._heights
+        column = move.get_column()
+        landing_row = 0
+        for i, bottom in enumerate(move.get_shape().bottom_profile):
+            row = heights[column + i] - bottom
+            if row > landing_row:
+                landing_row = row
+        return landing_row
+
+    # Works out where the move would place the piece, without changing the
+    # board. Returns the row the piece lands on, the (row, column) of every
+    # block it would place, and the rows it would fill, lowest first.
+    # The move's column should already have been checked by move_column_valid
+    def get_placement(self, move):
+        board_row = self.get_landing_row(move)
+        column = move.get_column()
+        shape = move.get_shape()
+        cells = [(board_row + cell[0], column + cell[1])
+                 for cell in shape.cells]
+        full_lines = []
+        for row in range(0, shape.height):
+            mask = self.get_row_mask(board_row + row)
+            if mask | shape.row_masks[row] << column == self._full_row:
+                full_lines.append(board_row + row)
+        return (board_row, cells, full_lines)
+
+    # Applies the move to the board.
+    # Returns an undo record which can be given to undo_move to restore the
+    # board to exactly how it was before the move. The record holds the move,
+    # the row it was placed at, the lines it cleared, the old skyline and the
+    # old hashes.
+    # Only the rows the piece lands on can become full, so only they are
+    # checked.
     def apply_move(self, move):
         if not self.move_column_valid(move):
             raise Exception("Move column not valid, unable to get valid value")
-        # Loops from top row to the bottom row until a row with a collision
-        # is found. The piece is then placed on the row it. If no such row
-        # is found, the piece is placed on row 0
-        for board_row in reversed(range(0, self.get_num_rows())):
-            if self.collision_at_row(move, board_row):
-                self.place_piece_at_row(move, board_row + 1)
-                self.remove_full_lines()
-                return
-        self.place_piece_at_row(move, 0)
-        self.remove_full_lines()
+        board_row = self.get_landing_row(move)
+        num_rows = len(self._grid)
+        heights = list(self._heights)
+        hashes = (self._hash, self._mirror_hash)
+        self.place_piece_at_row(move, board_row)
+        cleared = self.remove_full_lines(board_row,
+                                         board_row + move.get_height() - 1)
+        return (move, board_row, num_rows, cleared, heights, hashes)
+
+    # Reverts a move applied by apply_move, given its undo record.
+    # Moves must be undone in the reverse order they were applied.
+    def undo_move(self, record):
+        move, board_row, num_rows, cleared, heights, hashes = record
+        for line in cleared:
+            self._grid.insert(line[0], line[1])
+        self._rows_cleared -= len(cleared)
+        self._num_blocks += len(cleared) * self._width
+        self.remove_piece_at_row(move, board_row)
+        del self._grid[num_rows:]
+        self._heights = heights
+        self._hash, self._mirror_hash = hashes
 
     # makes a copy of the board, applies the move to it, then returns the copy
     def apply_move_copy(self, move):
@@ -149,7 +320,127 @@ class Board:
             sys.stdout.write("\n")
         sys.stdout.write("\n")
 
-    
+# An alternate engine for Board with the same public interface.
+# Each entry of _grid is an integer bitmask of a row instead of a list of
+# booleans, bit n being set if there is a block in column n.
+# Collision, placement and full-row detection work on whole rows at once
+# using bitwise operations, rather than cell by cell.
+class BitBoard(Board):
+    # Copying a list of ints is much cheaper than a deepcopy
+    def copy(self):
+        cp = self.__class__(self._width)
+        cp._grid = list(self._grid)
+        cp._heights = list(self._heights)
+        cp._num_blocks = self._num_blocks
+        cp._rows_cleared = self._rows_cleared
+        cp._hash = self._hash
+        cp._mirror_hash = self._mirror_hash
+        return cp
+
+    def place_block(self, row, column):
+        diff = row - len(self._grid) + 1
+        if diff > 0:
+            for i in range(0, diff):
+                self.append_row()
+
+        if column >= self._width:
+            raise Exception("column given is larger than width")
+        if self._grid[row] >> column & 1:
+            raise Exception("block already at position")
+
+        self._grid[row] |= 1 << column
+        self._num_blocks += 1
+        self.toggle_hash(row, column)
+        if row >= self._heights[column]:
+            self._heights[column] = row + 1
+
+    def block_at(self, row, column):
+        if column >= self._width:
+            raise Exception("column given is larger than width")
+        if row < len(self._grid):
+            return self._grid[row] >> column & 1 == 1
+        else:
+            return False
+
+    def get_row_mask(self, row):
+        if row >= len(self._grid):
+            return 0
+        return self._grid[row]
+
+    def append_row(self):
+        self._grid.append(0)
+
+    def remove_full_lines(self, first=0, last=None):
+        grid = self._grid
+        if last is None or last >= len(grid):
+            last = len(grid) - 1
+        full_row = self._full_row
+        removed = [(i, full_row) for i in range(first, last + 1)
+                   if grid[i] == full_row]
+        if removed:
+            self.toggle_hash_from(removed[0][0])
+            for line in reversed(removed):
+                del grid[line[0]]
+            self._rows_cleared += len(removed)
+            self._num_blocks -= len(removed) * self._width
+            self.toggle_hash_from(removed[0][0])
+            self.update_heights(len(removed))
+        return removed
+
+    # Helper function for apply_move
+    def collision_at_row(self, move, board_row):
+        grid = self._grid
+        masks = move.get_shape().row_masks
+        column = move.get_column()
+        for row in range(0, min(len(masks), len(grid) - board_row)):
+            if grid[board_row + row] & (masks[row] << column):
+                return True
+        return False
+
+    # Helper function for apply_move
+    def place_piece_at_row(self, move, board_row):
+        shape = move.get_shape()
+        masks = shape.row_masks
+        diff = board_row + len(masks) - len(self._grid)
+        if diff > 0:
+            for i in range(0, diff):
+                self.append_row()
+        column = move.get_column()
+        for row in range(0, len(masks)):
+            mask = masks[row] << column
+            if self._grid[board_row + row] & mask:
+                raise Exception("block already at position")
+            self._grid[board_row + row] |= mask
+        for cell in shape.cells:
+            self.toggle_hash(board_row + cell[0], column + cell[1])
+        self._num_blocks += len(shape.cells)
+        heights = self._heights
+        for i, top in enumerate(shape.top_profile):
+            if board_row + top > heights[column + i]:
+                heights[column + i] = board_row + top
+
+    def remove_piece_at_row(self, move, board_row):
+        shape = move.get_shape()
+        masks = shape.row_masks
+        column = move.get_column()
+        for row in range(0, len(masks)):
+            self._grid[board_row + row] &= ~(masks[row] << column)
+        for cell in shape.cells:
+            self.toggle_hash(board_row + cell[0], column + cell[1])
+        self._num_blocks -= len(shape.cells)
+
+    def print_grid(self):
+        for row in reversed(self._grid):
+            sys.stdout.write("|")
+            for column in range(0, self._width):
+                if row >> column & 1:
+                    sys.stdout.write("X")
+                else:
+                    sys.stdout.write(" ")
+                sys.stdout.write("|")
+            sys.stdout.write("\n")
+        sys.stdout.write("\n")
+
 
 def test():
     b = Board(11)
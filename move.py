@@ -1,6 +1,118 @@
 import sys
 
-class Move:
+# Builds the representation of a piece with a given rotation.
+# The representation is a tuple of rows, starting at the bottom, each row
+# being a tuple of booleans that are True where the piece has a block.
+def make_representation(piece, rotation):
+    representation = ()
+    if piece == 1:
+        # I block
+        if rotation == 0 or rotation == 2:
+            representation = ((True,), (True,), (True,), (True,))
+        else:
+            representation = ((True, True, True, True),)
+    elif piece == 2:
+        # O block
+        representation = ((True, True), (True, True))
+        pass
+    elif piece == 3:
+        # T block
+        if rotation == 0:
+            representation = ((True, False), (True, True), (True, False))
+        elif rotation == 1:
+            representation = ((True, True, True), (False, True, False))
+        elif rotation == 2:
+            representation = ((False, True), (True, True), (False, True))
+        elif rotation == 3:
+            representation = ((False, True, False), (True, True, True))
+    elif piece == 4:
+        # L block
+        if rotation == 0:
+            representation = ((True, False), (True, False), (True, True))
+        elif rotation == 1:
+            representation = ((True, True, True), (True, False, False))
+        elif rotation == 2:
+            representation = ((True, True), (False, True), (False, True))
+        elif rotation == 3:
+            representation = ((False, False, True), (True, True, True))
+    elif piece == 5:
+        # J block
+        if rotation == 0:
+            representation = ((False, True), (False, True), (True, True))
+        elif rotation == 1:
+            representation = ((True, False, False), (True, True, True))
+        elif rotation == 2:
+            representation = ((True, True), (True, False), (True, False))
+        elif rotation == 3:
+            representation = ((True, True, True), (False, False, True))
+    elif piece == 6:
+        # S block
+        if rotation == 0 or rotation == 2:
+            representation = ((False, True), (True, True), (True, False))
+        elif rotation == 1 or rotation == 3:
+            representation = ((True, True, False), (False, True, True))
+    elif piece == 7:
+        # Z block
+        if rotation == 0 or rotation == 2:
+            representation = ((True, False), (True, True), (False, True))
+        elif rotation == 1 or rotation == 3:
+            representation = ((False, True, True), (True, True, False))
+    return representation
+
+# Holds everything about the shape of a piece with a given rotation.
+# One Shape exists for each (piece, rotation) pair, in SHAPES, and every Move
+# points to the Shape it uses rather than building its own.
+# cells is a tuple of the (row, column) offsets of each block.
+# row_masks holds an integer bitmask of each row, bit n being column n.
+# bottom_profile holds, for each column, the row of its lowest block.
+# top_profile holds, for each column, the row above its highest block.
+class Shape(object):
+    __slots__ = ('representation', 'width', 'height', 'cells', 'row_masks',
+                 'bottom_profile', 'top_profile')
+
+    def __init__(self, representation):
+        self.representation = representation
+        self.height = len(representation)
+        self.width = len(representation[0])
+        self.cells = tuple((row, column)
+                           for row in range(0, self.height)
+                           for column in range(0, self.width)
+                           if representation[row][column])
+        masks = []
+        for row in representation:
+            mask = 0
+            for column in range(0, self.width):
+                if row[column]:
+                    mask |= 1 << column
+            masks.append(mask)
+        self.row_masks = tuple(masks)
+        bottom = []
+        top = []
+        for column in range(0, self.width):
+            rows = [row for row in range(0, self.height)
+                    if representation[row][column]]
+            bottom.append(rows[0])
+            top.append(rows[-1] + 1)
+        self.bottom_profile = tuple(bottom)
+        self.top_profile = tuple(top)
+
+# SHAPES[piece - 1][rotation] is the Shape of a piece with a given rotation
+SHAPES = tuple(tuple(Shape(make_representation(piece, rotation))
+                     for rotation in range(0, 4))
+               for piece in range(1, 8))
+
+# DISTINCT_ROTATIONS[piece - 1] holds the rotations of a piece that have a
+# different shape to every rotation before them, e.g. only rotation 0 for the
+# O block, and 0 and 1 for the I, S and Z blocks.
+DISTINCT_ROTATIONS = tuple(
+    tuple(rotation for rotation in range(0, 4)
+          if all(shapes[rotation].cells != shapes[previous].cells
+                 for previous in range(0, rotation)))
+    for shapes in SHAPES)
+
+class Move(object):
+    __slots__ = ('_piece', '_rotation', '_column', '_shape')
+
     def __init__(self, piece, rotation, column):
         # Parameter checking
         if piece > 7 or piece < 1:
@@ -12,66 +124,17 @@ class Move:
         self._piece = piece
         self._rotation = rotation
         self._column  = column
-        self._representation = self.make_representation()
+        self._shape = SHAPES[piece - 1][rotation]
+
+    # Classes with __slots__ need to say how to be pickled
+    def __reduce__(self):
+        return (Move, (self._piece, self._rotation, self._column))
 
     def make_representation(self):
-        representation = ()
-        if self._piece == 1:
-            # I block
-            if self._rotation == 0 or self._rotation == 2:
-                representation = ((True,), (True,), (True,), (True,))
-            else:
-                representation = ((True, True, True, True),)
-        elif self._piece == 2:
-            # O block
-            representation = ((True, True), (True, True))
-            pass
-        elif self._piece == 3:
-            # T block
-            if self._rotation == 0:
-                representation = ((True, False), (True, True), (True, False))
-            elif self._rotation == 1:
-                representation = ((True, True, True), (False, True, False))
-            elif self._rotation == 2:
-                representation = ((False, True), (True, True), (False, True))
-            elif self._rotation == 3:
-                representation = ((False, True, False), (True, True, True))
-        elif self._piece == 4:
-            # L block
-            if self._rotation == 0:
-                representation = ((True, False), (True, False), (True, True))
-            elif self._rotation == 1:
-                representation = ((True, True, True), (True, False, False))
-            elif self._rotation == 2:
-                representation = ((True, True), (False, True), (False, True))
-            elif self._rotation == 3:
-                representation = ((False, False, True), (True, True, True))
-        elif self._piece == 5:
-            # J block
-            if self._rotation == 0:
-                representation = ((False, True), (False, True), (True, True))
-            elif self._rotation == 1:
-                representation = ((True, False, False), (True, True, True))
-            elif self._rotation == 2:
-                representation = ((True, True), (True, False), (True, False))
-            elif self._rotation == 3:
-                representation = ((True, True, True), (False, False, True))
-        elif self._piece == 6:
-            # S block
-            if self._rotation == 0 or self._rotation == 2:
-                representation = ((False, True), (True, True), (True, False))
-            elif self._rotation == 1 or self._rotation == 3:
-                representation = ((True, True, False), (False, True, True))
-        elif self._piece == 7:
-            # Z block
-            if self._rotation == 0 or self._rotation == 2:
-                representation = ((True, False), (True, True), (False, True))
-            elif self._rotation == 1 or self._rotation == 3:
-                representation = ((False, True, True), (True, True, False))
-        return representation
+        return self._shape.representation
 
     def print_representation(self):
-        for row in reversed(self._representation):
+        for row in reversed(self._shape.representation):
             sys.stdout.write("|")
             for column in row:
                 if column:
@@ -82,7 +145,7 @@ class Move:
             sys.stdout.write("\n")
 
     def print_rep_with_column(self):
-        for row in reversed(self._representation):
+        for row in reversed(self._shape.representation):
             sys.stdout.write("|")
             sys.stdout.write(" |" * self._column)
             for column in row:
@@ -93,14 +156,26 @@ class Move:
                 sys.stdout.write("|")
             sys.stdout.write("\n")
 
+    def get_shape(self):
+        return self._shape
+
     def get_width(self):
-        return len(self._representation[0])
+        return self._shape.width
 
     def get_height(self):
-        return len(self._representation)
+        return self._shape.height
 
     def block_at(self, row, column):
-        return self._representation[row][column]
+        return self._shape.representation[row][column]
+
+    def get_bottom_profile(self):
+        return self._shape.bottom_profile
+
+    def get_top_profile(self):
+        return self._shape.top_profile
+
+    def get_row_masks(self):
+        return self._shape.row_masks
 
     def get_piece(self):
         return self._piece
@@ -1,6 +1,9 @@
 import copy
 import sys
 import random
+import re
+import mmap
+import collections
 import operator
 import pickle
 import argparse
@@ -8,66 +11,568 @@ import numpy as np
 import sys
 import time
 import os
+import itertools
+import multiprocessing
+import ctypes
+import struct
 
 import board
 import move
 import utility
 from tools.tree import *
 import tools.piece_definitions
+import tools.flattree
+
+# Matches the digits at the start of each line, the rest of a line is skipped
+PIECES_RE = re.compile(r"^[0-9]+", re.MULTILINE)
+
+# Generates the pieces in a file one at a time, without reading the whole
+# file into memory. The file is memory mapped and the digits at the start of
+# each line are found by a regular expression, rather than going through the
+# file a character at a time. Digits 8 and 9 are skipped.
+def iter_pieces_from_file(filename):
+    with open(filename, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for match in PIECES_RE.finditer(m):
+                for char in match.group().translate(None, "89"):
+                    yield ord(char) - ord("0")
+        finally:
+            m.close()
 
 def get_pieces_from_file(filename):
-    pieces = []
-    with open(filename, "r") as f:
-        for line in f:
-            for char in line:
-                if char.isdigit():
-                    digit = int(char)
-                    if digit >= 0 and digit <= 7:
-                        pieces.append(digit)
-                else:
-                    # skip rest of this line
-                    break
-    return pieces
+    return list(iter_pieces_from_file(filename))
+
+# Writes a solution to a file as the moves are decided.
+# Has an append method so it can be given to get_solution in place of the
+# solution list. Moves are written out in chunks of chunk_size lines, so only
+# one chunk is ever held in memory.
+class SolutionWriter:
+    def __init__(self, filename, chunk_size=4096):
+        self._file = open(filename, "w")
+        self._chunk_size = chunk_size
+        self._lines = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def append(self, m):
+        self._lines.append("{0} {1} {2}\n".format(m.get_piece(),
+                                                  m.get_rotation(),
+                                                  m.get_column()))
+        if len(self._lines) >= self._chunk_size:
+            self.flush()
+
+    def flush(self):
+        self._file.write("".join(self._lines))
+        self._lines = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
 
 def write_solution_to_file(solution, filename):
-    with open(filename, "w") as f:
+    with SolutionWriter(filename) as w:
         for m in solution:
-            f.write("{0} {1} {2}\n".format(m.get_piece(), m.get_rotation(),
-                                      m.get_column()))
+            w.append(m)
+
+# Generates every distinct move that can be made with the pieces, once each.
+# The moves come in the same order get_best_move used to try them in: by
+# piece, rotation, then column. Rotations with the same shape as an earlier
+# one, columns that would be moved back inside the right wall, and pieces
+# already seen in the buffer are skipped, as they would place the piece
+# exactly where an earlier move did.
+def get_placements(board, pieces):
+    width = board.get_width()
+    seen = set()
+    for piece in pieces:
+        if piece in seen:
+            continue
+        seen.add(piece)
+        for rotation in move.DISTINCT_ROTATIONS[piece - 1]:
+            shape = move.SHAPES[piece - 1][rotation]
+            for column in range(0, width - shape.width + 1):
+                yield move.Move(piece, rotation, column)
+
+# Returns whether the utility function can score boards exactly from their
+# utility terms, see utility.variable_alpha
+def uses_terms(utility_function):
+    return getattr(utility_function, "terms_exact", False)
+
+# Scores every move that can be made on the board with the pieces.
+# Returns a list of (utility, move) pairs in the order of get_placements.
+# Utility functions that can score a board from its utility terms are given
+# the terms of each move, worked out from the terms of the current board,
+# instead of the whole board. If the utility function has a cache, see
+# utility.CachedUtility, moves that fill no rows are looked up in it first.
+def get_move_utilities(board, pieces, utility_function):
+    incremental = uses_terms(utility_function)
+    cache = getattr(utility_function, "cache", None)
+    if incremental:
+        terms = utility.get_terms(board)
+    scored = []
+    for m in get_placements(board, pieces):
+        if incremental:
+            _, cells, full_lines = board.get_placement(m)
+            key = None
+            u = None
+            if cache is not None and not full_lines:
+                key = board.get_canonical_hash_with(cells)
+                u = cache.get(key)
+            if u is None:
+                u = utility_function.evaluate_terms(
+                    utility.get_terms_after(board, terms, cells, full_lines))
+                if key is not None:
+                    cache.put(key, u)
+        else:
+            # Apply the move, evaluate the board, then take it back again,
+            # rather than evaluating a copy of the board
+            record = board.apply_move(m)
+            u = utility_function(board)
+            board.undo_move(record)
+        scored.append((u, m))
+    return scored
 
 def get_best_move(board, pieces, utility_function):
     best_move = None
     best_utility = -100000
-    for piece in pieces:
-        for rotation in range(0, 4):
-            for column in range(0, board.get_width()):
-                m = move.Move(piece, rotation, column)
-                if board.move_column_valid(m):
-                    b = board.apply_move_copy(m)
-                    utility = utility_function(b)
-                    if utility > best_utility:
-                        best_move = m
-                        best_utility = utility
+    for u, m in get_move_utilities(board, pieces, utility_function):
+        if u > best_utility:
+            best_move = m
+            best_utility = u
     return best_move
 
-def get_solution(pieces, width, buffer_size, utility_function, visualise):
-    #pieces = get_pieces_from_file(input_file)
+# Returns the board as a NumPy boolean array with num_rows rows, row 0 at
+# the bottom. Rows above the top of the board are empty.
+def board_to_array(b, num_rows):
+    masks = np.array([b.get_row_mask(row) for row in range(0, num_rows)],
+                     np.int64)
+    return (masks[:, None] >> np.arange(b.get_width())) & 1 == 1
+
+# The cell rows, cell columns and bottom profile of each shape as NumPy
+# arrays, by (piece, rotation), for get_batch_placements
+SHAPE_ARRAYS = dict(((piece, rotation),
+                     (np.array([cell[0] for cell in shape.cells]),
+                      np.array([cell[1] for cell in shape.cells]),
+                      np.array(shape.bottom_profile)))
+                    for piece in range(1, 8)
+                    for rotation, shape in enumerate(move.SHAPES[piece - 1]))
+
+# Works out where every move of get_placements would place its piece at
+# once, straight from the skyline of the board, without making a Move for
+# each. Every column a shape can go in is landed in one NumPy step, in the
+# same way as Board.get_landing_row.
+# Returns the rows and columns of the cells of each move, as two arrays of
+# shape (moves, 4), and a list of (piece, rotation, moves) for each shape in
+# order, the moves of a shape being one per column from column 0.
+def get_batch_placements(board, pieces):
+    width = board.get_width()
+    heights = np.array(board.get_heights())
+    groups = []
+    cell_rows = []
+    cell_columns = []
+    seen = set()
+    for piece in pieces:
+        if piece in seen:
+            continue
+        seen.add(piece)
+        for rotation in move.DISTINCT_ROTATIONS[piece - 1]:
+            rows, columns, bottom = SHAPE_ARRAYS[(piece, rotation)]
+            n = width - len(bottom) + 1
+            if n <= 0:
+                continue
+            starts = np.arange(n)[:, None]
+            landing = (heights[starts + np.arange(len(bottom))] -
+                       bottom).max(axis=1)
+            landing = np.maximum(landing, 0)[:, None]
+            cell_rows.append(landing + rows)
+            cell_columns.append(starts + columns)
+            groups.append((piece, rotation, n))
+    if not groups:
+        return None, None, groups
+    return np.concatenate(cell_rows), np.concatenate(cell_columns), groups
+
+# Same as get_best_move, but evaluates every candidate move at once.
+# The boards resulting from every candidate are built as one NumPy array and
+# scored with the utility function's evaluate_batch. Candidates are placed by
+# get_batch_placements in the order of get_placements, and the first best
+# one is picked, so the same move as get_best_move is chosen. Utility
+# functions that cannot score boards exactly from their terms are left to
+# get_best_move.
+def get_best_move_batched(board, pieces, utility_function):
+    width = board.get_width()
+    if not uses_terms(utility_function) or width > 62:
+        return get_best_move(board, pieces, utility_function)
+    cell_rows, cell_columns, groups = get_batch_placements(board, pieces)
+    if not groups:
+        return None
+    num_moves = len(cell_rows)
+    cell_boards = np.repeat(np.arange(num_moves), cell_rows.shape[1])
+    # 4 rows is enough room for any piece to land on top of the board
+    num_rows = board.get_num_rows() + 4
+    boards = np.repeat(board_to_array(board, num_rows)[None], num_moves,
+                       axis=0)
+    boards[cell_boards, cell_rows.ravel(), cell_columns.ravel()] = True
+    # Full rows are removed by moving every other row down in order, and
+    # filling the top back up with empty rows
+    full = boards.all(axis=2)
+    if full.any():
+        order = np.argsort(full, axis=1, kind="mergesort")
+        boards = boards[np.arange(num_moves)[:, None], order]
+        kept = num_rows - full.sum(axis=1)
+        boards &= (np.arange(num_rows)[None, :] < kept[:, None])[:, :, None]
+    utilities = utility_function.evaluate_batch(boards)
+    best = np.argmax(utilities)
+    if utilities[best] <= -100000:
+        return None
+    for piece, rotation, n in groups:
+        if best < n:
+            return move.Move(piece, rotation, int(best))
+        best -= n
+
+# A move function for get_solution that looks ahead over the pieces in the
+# buffer with a beam search, rather than only at the board after one move.
+# At each ply every move of every piece left in the buffer is tried on each
+# board in the beam, and the beam_width best resulting boards are kept for
+# the next ply. After depth plies (or when the buffer runs out), the first
+# move on the way to the best board is returned.
+# At most depth * beam_width boards are expanded per move, so the time taken
+# per move does not grow with the length of the game. With a depth of 1 the
+# same moves as get_best_move are chosen.
+class BeamSearch:
+    def __init__(self, depth, beam_width):
+        self._depth = depth
+        self._beam_width = beam_width
+
+    def __call__(self, board, pieces, utility_function):
+        # Each node in the beam is (board, pieces left, first move)
+        beam = [(board, list(pieces), None)]
+        best_move = None
+        for ply in range(0, min(self._depth, len(pieces))):
+            children = []
+            for i, node in enumerate(beam):
+                for u, m in get_move_utilities(node[0], node[1],
+                                               utility_function):
+                    children.append((-u, len(children), i, m))
+            if not children:
+                break
+            # Ties go to the earliest child, as in get_best_move
+            children.sort()
+            next_beam = []
+            for _, _, i, m in children[0:self._beam_width]:
+                b, remaining, first_move = beam[i]
+                b = b.copy()
+                b.apply_move(m)
+                remaining = list(remaining)
+                remaining.remove(m.get_piece())
+                next_beam.append((b, remaining, first_move or m))
+            beam = next_beam
+            best_move = beam[0][2]
+        return best_move
+
+# Raised inside ExpectimaxSearch when the time for a move has run out
+class SearchTimeout(Exception):
+    pass
+
+# Picks moves by expectimax, looking past the buffer at the pieces that
+# could come next.
+# After each move one new piece joins the buffer. That piece is not known,
+# so at a chance node the value of the board is the average of the best
+# value with each of the 7 pieces added to the buffer, weighted by the
+# probability of that piece. Boards are valued by the utility function once
+# depth moves have been made, so a depth of 1 is the same as get_best_move.
+# probabilities gives the chance of each piece, 1 to 7. If it is not given,
+# the chances are estimated from the pieces seen so far, with one extra of
+# each piece counted so that unseen pieces are still possible.
+# The value of a chance node only depends on the board, the pieces left in
+# the buffer and the depth, so values are memoised by those. The exact board
+# hash is used rather than the canonical one: a mirrored board would need
+# mirrored pieces, as mirroring swaps L with J and S with Z.
+# Depths are searched one after the other up to depth, and if time_limit
+# seconds pass before a depth is finished, the move from the last finished
+# depth is used. If max_candidates is given, only that many of the best
+# moves by utility are searched below the first move.
+# If table is given, a TranspositionTable, values are memoised in it rather
+# than in a dict.
+class ExpectimaxSearch:
+    def __init__(self, depth, probabilities=None, time_limit=None,
+                 max_candidates=None, table=None):
+        self._depth = depth
+        self._probabilities = probabilities
+        self._time_limit = time_limit
+        self._max_candidates = max_candidates
+        self._table = table
+        self._counts = [0] * 7
+        self._last_buffer = None
+        self._last_piece = None
+        self._memo = {}
+        self._deadline = None
+        self._utility_function = None
+        self._piece_probabilities = None
+
+    # Counts the pieces that have joined the buffer since the last call
+    def observe(self, pieces):
+        arrived = collections.Counter(pieces)
+        if self._last_buffer is not None:
+            arrived.subtract(self._last_buffer)
+            arrived[self._last_piece] += 1
+        for piece, count in arrived.iteritems():
+            if count > 0:
+                self._counts[piece - 1] += count
+        self._last_buffer = collections.Counter(pieces)
+
+    # Returns (piece, probability) for each piece that can come next
+    def get_probabilities(self):
+        if self._probabilities is not None:
+            total = float(sum(self._probabilities))
+            weights = self._probabilities
+        else:
+            total = float(sum(self._counts) + 7)
+            weights = [count + 1 for count in self._counts]
+        return [(piece, weights[piece - 1] / total)
+                for piece in range(1, 8) if weights[piece - 1] > 0]
+
+    def __call__(self, board, pieces, utility_function):
+        self.observe(pieces)
+        best_move = get_best_move(board, pieces, utility_function)
+        if best_move is not None:
+            deadline = None
+            if self._time_limit is not None:
+                deadline = time.time() + self._time_limit
+            self.start_search(utility_function, self.get_probabilities(),
+                              deadline)
+            self.clear_memo()
+            try:
+                for depth in range(2, self._depth + 1):
+                    best_move = self.get_best_move(board, list(pieces), depth)
+            except SearchTimeout:
+                pass
+            self.clear_memo()
+        if best_move is not None:
+            self._last_piece = best_move.get_piece()
+        return best_move
+
+    # Sets what a search for one move uses
+    def start_search(self, utility_function, piece_probabilities, deadline):
+        self._utility_function = utility_function
+        self._piece_probabilities = piece_probabilities
+        self._deadline = deadline
+
+    def clear_memo(self):
+        self._memo = {}
+        if self._table is not None:
+            self._table.clear()
+
+    # Returns the best move with depth moves to look ahead over.
+    # Ties go to the earliest move, as in get_best_move.
+    def get_best_move(self, board, pieces, depth):
+        best_move = None
+        best_value = float('-inf')
+        for u, m in get_move_utilities(board, pieces, self._utility_function):
+            value = self.get_move_value(board, pieces, m, depth)
+            if value > best_value:
+                best_move = m
+                best_value = value
+        return best_move
+
+    # Returns the value of making move m, with depth moves to look ahead over
+    # including m
+    def get_move_value(self, board, pieces, m, depth):
+        record = board.apply_move(m)
+        remaining = list(pieces)
+        remaining.remove(m.get_piece())
+        try:
+            return self.get_chance_value(board, remaining, depth - 1)
+        finally:
+            board.undo_move(record)
+
+    # Returns the value of the board before the next piece joins the buffer
+    def get_chance_value(self, board, pieces, depth):
+        pieces_key = tuple(sorted(pieces))
+        if self._table is None:
+            key = (board.get_width(), board.get_hash(), pieces_key, depth)
+            value = self._memo.get(key)
+        else:
+            key = self._table.make_key(board, pieces_key, depth)
+            value = self._table.get(key)
+        if value is None:
+            if self._deadline is not None and time.time() > self._deadline:
+                raise SearchTimeout()
+            value = 0
+            for piece, probability in self._piece_probabilities:
+                value += probability * self.get_max_value(board,
+                                                          pieces + [piece],
+                                                          depth)
+            if self._table is None:
+                self._memo[key] = value
+            else:
+                self._table.put(key, value)
+        return value
+
+    # Returns the value of the best move on the board with the pieces
+    def get_max_value(self, board, pieces, depth):
+        scored = get_move_utilities(board, pieces, self._utility_function)
+        if not scored:
+            return self._utility_function(board)
+        if depth == 1:
+            return max(u for u, m in scored)
+        if self._max_candidates is not None:
+            # Stable, so ties keep the order of get_placements
+            scored.sort(key=lambda x: -x[0])
+            del scored[self._max_candidates:]
+        return max(self.get_move_value(board, pieces, m, depth)
+                   for u, m in scored)
+
+# A table of values shared between processes, for memoising
+# ExpectimaxSearch. It must be made before the processes are started.
+# Keys are 64 bit numbers, and each is stored in the slot given by its low
+# bits, replacing whatever was there before.
+# Entries are written without a lock, so a reader may see the key of one
+# write and the value of another. To catch that, the key is stored xored
+# with the value, and an entry is only used if xoring them back gives the
+# key that was looked up.
+class TranspositionTable:
+    def __init__(self, size_bits=20):
+        self._mask = (1 << size_bits) - 1
+        self._keys = multiprocessing.RawArray(ctypes.c_uint64, 1 << size_bits)
+        self._values = multiprocessing.RawArray(ctypes.c_uint64,
+                                                1 << size_bits)
+
+    # Returns the key for the value of a board with the sorted pieces left in
+    # its buffer and depth moves to go. The exact board hash is used, as in
+    # ExpectimaxSearch.
+    def make_key(self, board, pieces, depth):
+        code = depth
+        for piece in pieces:
+            code = code * 8 + piece
+        code = code * 256 + board.get_width()
+        return (board.get_hash() ^
+                code * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+
+    def get(self, key):
+        i = key & self._mask
+        bits = self._values[i]
+        # An empty slot, a stored 0.0 is just worked out again
+        if bits == 0:
+            return None
+        if self._keys[i] ^ bits != key:
+            return None
+        return struct.unpack("<d", struct.pack("<Q", bits))[0]
+
+    def put(self, key, value):
+        i = key & self._mask
+        bits = struct.unpack("<Q", struct.pack("<d", value))[0]
+        self._keys[i] = key ^ bits
+        self._values[i] = bits
+
+    def clear(self):
+        ctypes.memset(self._keys, 0, ctypes.sizeof(self._keys))
+        ctypes.memset(self._values, 0, ctypes.sizeof(self._values))
+
+# The ExpectimaxSearch of a worker process of ParallelExpectimaxSearch
+worker_search = None
+
+def init_expectimax_worker(table, max_candidates):
+    global worker_search
+    worker_search = ExpectimaxSearch(0, max_candidates=max_candidates,
+                                     table=table)
+
+# Returns the value of one move at the top of a ParallelExpectimaxSearch,
+# or None if the time ran out.
+def expectimax_worker(data):
+    (board, pieces, m, depth, utility_function, piece_probabilities,
+     deadline) = data
+    worker_search.start_search(utility_function, piece_probabilities,
+                               deadline)
+    try:
+        return worker_search.get_move_value(board, pieces, m, depth)
+    except SearchTimeout:
+        return None
+
+# ExpectimaxSearch with the moves at the top of the search shared out
+# between a pool of worker processes, processes of them, or one per CPU if
+# not given. The workers memoise values in one TranspositionTable in shared
+# memory, so a board one worker has valued is not valued again by another.
+# Each key is for one board, buffer and depth, so every value is worked out
+# the same way whichever process works it out, and the first move with the
+# highest value is picked, so the same moves as
+# ExpectimaxSearch are chosen, as long as time_limit is not reached.
+# close must be called when finished with, to stop the workers.
+class ParallelExpectimaxSearch(ExpectimaxSearch):
+    def __init__(self, depth, probabilities=None, time_limit=None,
+                 max_candidates=None, processes=None, table_size_bits=20):
+        ExpectimaxSearch.__init__(self, depth, probabilities, time_limit,
+                                  max_candidates,
+                                  TranspositionTable(table_size_bits))
+        self._pool = multiprocessing.Pool(processes, init_expectimax_worker,
+                                          (self._table, max_candidates))
+
+    def get_best_move(self, board, pieces, depth):
+        moves = [m for u, m in get_move_utilities(board, pieces,
+                                                  self._utility_function)]
+        values = self._pool.map(expectimax_worker,
+                                [(board, pieces, m, depth,
+                                  self._utility_function,
+                                  self._piece_probabilities, self._deadline)
+                                 for m in moves], 1)
+        if None in values:
+            raise SearchTimeout()
+        best_move = None
+        best_value = float('-inf')
+        for value, m in zip(values, moves):
+            if value > best_value:
+                best_move = m
+                best_value = value
+        return best_move
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+# Keeps statistics of a game as it is played, so the solution does not need
+# to be replayed afterwards. Updated after every move by get_solution and
+# tree_get_solution when given to them.
+class GameResults:
+    def __init__(self):
+        self.moves = 0
+        self.height = 0
+        self.max_height = 0
+        self.rows_cleared = 0
+        self.holes = 0
+
+    def update(self, b):
+        self.moves += 1
+        self.height = b.get_num_rows()
+        if self.height > self.max_height:
+            self.max_height = self.height
+        self.rows_cleared = b.get_rows_cleared()
+        self.holes = b.get_num_holes()
+
+# pieces can be any iterable of pieces, such as iter_pieces_from_file, and is
+# only read from as pieces are needed.
+# Each move is appended to solution as it is decided, this can be anything
+# with an append method, such as a SolutionWriter. By default it is a list.
+# If results is given, it is a GameResults that is updated after each move.
+def get_solution(pieces, width, buffer_size, utility_function, visualise,
+                 board_class=board.BitBoard, move_function=get_best_move,
+                 solution=None, results=None):
     # builds the buffer
-    buffer_size += 1
-    piece_buffer = []
-    if len(pieces) <= buffer_size:
-        piece_buffer = pieces
-        pieces = []
-    else:
-        piece_buffer = pieces[0:buffer_size]
-        pieces = pieces[buffer_size:len(pieces)]
+    pieces = iter(pieces)
+    piece_buffer = collections.deque(itertools.islice(pieces,
+                                                      buffer_size + 1))
     #
-    b = board.Board(width)
+    b = board_class(width)
     #
-    solution = []
+    if solution is None:
+        solution = []
     # empty sequences are false
     while piece_buffer:
-        best_move = get_best_move(b, piece_buffer, utility_function)
+        best_move = move_function(b, piece_buffer, utility_function)
         if visualise:
             print("best move:")
             best_move.print_rep_with_column()
@@ -81,9 +586,10 @@ def get_solution(pieces, width, buffer_size, utility_function, visualise):
             print("-" * 20)
             pass
         solution.append(best_move)
+        if results is not None:
+            results.update(b)
         piece_buffer.remove(best_move.get_piece())
-        if pieces:
-            piece_buffer.append(pieces.pop(0))
+        piece_buffer.extend(itertools.islice(pieces, 1))
     return (b, solution)
 
 def get_solution_height(solution, width):
@@ -119,29 +625,39 @@ def get_random_pieces(seed, num_piece_groups, num_pieces_per_groud):
 
 def review(seed, num_tests, num_pieces_per_test, width, buffer_size, args):
     pieces = get_random_pieces(seed, num_tests, num_pieces_per_test)
+    weights = list(itertools.product(*args[0:5]))
+    games = {}
+    for w in weights:
+        function = utility.variable_alpha(*w)
+        for i, piece_set in enumerate(pieces):
+            results = GameResults()
+            get_solution(piece_set, width, buffer_size, function, False,
+                         results=results)
+            games[(w, i)] = (results.height, results.max_height)
+    print_review(*get_review_averages(games, weights, num_tests))
+
+# Averages the height and max height of each set of weights over the first
+# num_tests tests, printing each as it goes. games is a dictionary of
+# (weights, index of test) to (height, max height).
+# Returns dictionaries of weights to average height and average max height.
+def get_review_averages(games, weights, num_tests):
     height_dictionary = {}
     max_height_dictionary = {}
-    for a in args[0]:
-        for b in args[1]:
-            for c in args[2]:
-                for d in args[3]:
-                    for e in args[4]:
-                        function = utility.variable_alpha(a, b, c, d, e)
-                        height = 0.0
-                        max_height = 0.0
-                        for piece_set in pieces:
-                            solution = get_solution(piece_set, width,
-                                                    buffer_size, function,
-                                                    False)
-                            height += get_solution_height(solution, width)
-                            max_height += get_solution_max_height(solution,
-                                                                  width)
-                        height /= num_tests
-                        max_height /= num_tests
-                        height_dictionary[(a, b, d, c, e)] = height
-                        max_height_dictionary[(a, b, d, c, e)] = max_height
-                        print((a, b, c, d, e), height, max_height)
-    #
+    for a, b, c, d, e in weights:
+        height = 0.0
+        max_height = 0.0
+        for i in range(0, num_tests):
+            height += games[((a, b, c, d, e), i)][0]
+            max_height += games[((a, b, c, d, e), i)][1]
+        height /= num_tests
+        max_height /= num_tests
+        height_dictionary[(a, b, d, c, e)] = height
+        max_height_dictionary[(a, b, d, c, e)] = max_height
+        print((a, b, c, d, e), height, max_height)
+    return height_dictionary, max_height_dictionary
+
+# Prints the 10 best weights by average height and by average max height
+def print_review(height_dictionary, max_height_dictionary):
     sorted_hd = sorted(height_dictionary.iteritems(), key=operator.itemgetter(1))
     sorted_mhd = sorted(max_height_dictionary.iteritems(),
                         key=operator.itemgetter(1))
@@ -156,30 +672,137 @@ def review(seed, num_tests, num_pieces_per_test, width, buffer_size, args):
         mh = max_height_dictionary[item[0]]
         print("{0} height: {1} max height: {2}".format(item[0], h, mh))
 
-def get_tree2():
-    path = 'trees/tree2.p'
+# Generates the pieces of one test of a review from its own random number
+# generator, seeded from the seed of the review and the index of the test.
+# A test gets the same pieces no matter which process plays it or when.
+def get_seeded_pieces(seed, index, num_pieces):
+    r = random.Random((seed << 32) + index)
+    return [r.randint(1, 7) for i in range(0, num_pieces)]
+
+# Plays one test of a review for one set of weights.
+# Takes a single tuple so it can be used with multiprocessing.Pool.imap
+def review_game(data):
+    weights, seed, index, num_pieces, width, buffer_size = data
+    pieces = get_seeded_pieces(seed, index, num_pieces)
+    results = GameResults()
+    get_solution(pieces, width, buffer_size, utility.variable_alpha(*weights),
+                 False, results=results)
+    return (weights, index, results.height, results.max_height)
+
+# Plays the games of a review for every set of weights over the tests with
+# the given indexes, spread over a pool of processes.
+# Returns a dictionary of (weights, index) to (height, max height).
+def play_review_games(pool, seed, indexes, num_pieces, width, buffer_size,
+                      weights):
+    jobs = [(w, seed, i, num_pieces, width, buffer_size)
+            for w in weights for i in indexes]
+    games = {}
+    # Each job is a whole game, so they are handed out one at a time to keep
+    # every process busy until the end
+    for w, i, height, max_height in pool.imap_unordered(review_game, jobs):
+        games[(w, i)] = (height, max_height)
+    return games
+
+# Same as review, but the games are played by a pool of processes, one
+# (weights, test) pair at a time, using all cores unless told otherwise.
+# Each test has its own seed (see get_seeded_pieces), and the heights of each
+# set of weights are added up in test order once every game is in, so the
+# results do not depend on the number of processes.
+def review_parallel(seed, num_tests, num_pieces_per_test, width, buffer_size,
+                    args, processes=None):
+    if seed is None:
+        seed = random.randint(0, 2 ** 31)
+        print("Review seed: {0}".format(seed))
+    weights = list(itertools.product(*args[0:5]))
+    pool = multiprocessing.Pool(processes)
+    # The workers are stopped even if a game raises, rather than being left
+    # running
+    try:
+        games = play_review_games(pool, seed, range(0, num_tests),
+                                  num_pieces_per_test, width, buffer_size,
+                                  weights)
+    finally:
+        pool.terminate()
+    print_review(*get_review_averages(games, weights, num_tests))
+
+# Same as review_parallel, but rather than playing every set of weights on
+# every test, uses successive halving to spend the games on the promising
+# ones. Every set of weights starts on initial_tests tests; after each round
+# only the best 1/eta by average height (then max height) are kept, and the
+# survivors play eta times as many tests in the next round. At least 10 sets
+# of weights are always kept, and the survivors finish on all num_tests
+# tests, so the top 10 tables only rank weights played on every test.
+# eta must be a whole number of at least 2, and num_tests and initial_tests
+# at least 1, or the number of tests played would never grow.
+def review_halving(seed, num_tests, num_pieces_per_test, width, buffer_size,
+                   args, eta=2, initial_tests=1, processes=None):
+    if eta < 2 or eta != int(eta):
+        raise ValueError("eta must be a whole number of at least 2")
+    if num_tests < 1 or initial_tests < 1:
+        raise ValueError("num_tests and initial_tests must be at least 1")
+    eta = int(eta)
+    if seed is None:
+        seed = random.randint(0, 2 ** 31)
+        print("Review seed: {0}".format(seed))
+    weights = list(itertools.product(*args[0:5]))
+    order = dict((w, i) for i, w in enumerate(weights))
+    pool = multiprocessing.Pool(processes)
+    games = {}
+    played = 0
+    n = min(initial_tests, num_tests)
+    try:
+        while True:
+            print("Playing {0} sets of weights on {1} tests".format(
+                len(weights), n))
+            games.update(play_review_games(pool, seed, range(played, n),
+                                           num_pieces_per_test, width,
+                                           buffer_size, weights))
+            played = n
+            if played >= num_tests:
+                break
+            def average(w):
+                height = 0.0
+                max_height = 0.0
+                for i in range(0, played):
+                    height += games[(w, i)][0]
+                    max_height += games[(w, i)][1]
+                return (height / played, max_height / played, order[w])
+            weights.sort(key=average)
+            weights = weights[0:max(10, len(weights) / eta)]
+            n = min(num_tests, n * eta)
+    finally:
+        pool.terminate()
+    averages = get_review_averages(games, weights, num_tests)
+    print("{0} games played".format(len(games)))
+    print_review(*averages)
+
+# Returns the root of the decision tree for boards of the given width.
+# The flat trees/treeN.pdt is used if it exists, as it is mapped into memory
+# rather than unpickled, otherwise the pickled tree is loaded.
+def load_tree_file(width):
+    path = 'trees/tree{0}.pdt'.format(width)
+    if os.path.exists(path):
+        return tools.flattree.load_tree(path)
+    path = 'trees/tree{0}.p'.format(width)
     if sys.platform.startswith('win32'):
-        path = 'trees/tree2_win.p'
+        path = 'trees/tree{0}_win.p'.format(width)
+    return pickle.load(open(path, 'rb'))
+
+def get_tree2():
     if not hasattr(get_tree2, "t"):
-        get_tree2.t = pickle.load(open(path, 'rb'))
+        get_tree2.t = load_tree_file(2)
         get_tree2.t.utility = 0
     return copy.copy(get_tree2.t)        
         
 def get_tree3():
-    path = 'trees/tree3.p'
-    if sys.platform.startswith('win32'):
-        path = 'trees/tree3_win.p'
     if not hasattr(get_tree3, "t"):
-        get_tree3.t = pickle.load(open(path, 'rb'))
+        get_tree3.t = load_tree_file(3)
         get_tree3.t.utility = 0
     return copy.copy(get_tree3.t)
 
 def get_tree4():
-    path = 'trees/tree4.p'
-    if sys.platform.startswith('win32'):
-        path = 'trees/tree4_win.p'
     if not hasattr(get_tree4, "t"):
-        get_tree4.t = pickle.load(open(path, 'rb'))
+        get_tree4.t = load_tree_file(4)
         get_tree4.t.utility = 0
     return copy.copy(get_tree4.t)
 
@@ -205,15 +828,32 @@ def load_trees(width):
     else:
         return load_trees(width - 4) + [get_tree4()]
     
-def tree_get_best_action(trees, times_filled, pieces):
+# Returns (action, utility) for the actions of a tree state for a piece
+# that tree_get_best_action needs to look at, in order. The utility is the
+# rank attribute of the state the action leads to, max_utility or
+# expected_utility.
+# States of flat trees already know which of their actions is best for each
+# piece, and only the first best action can be picked, so only it is given.
+def tree_get_piece_actions(tree, piece, rank="max_utility"):
+    if hasattr(tree, "get_best_action"):
+        best = tree.get_best_action(piece, rank)
+        if best is None:
+            return ()
+        return (best,)
+    return [(action, getattr(state, rank))
+            for action, state in tree.actions[piece].iteritems()]
+
+# Actions are ranked by the max_utility of the state they lead to, or by
+# rank if given, e.g. "expected_utility" for trees annotated by
+# tools/expected.py, which is experimental
+def tree_get_best_action(trees, times_filled, pieces, rank="max_utility"):
     best_action = None
     best_utility = None
     for i in range(0, len(trees)):
         tree = trees[i]
         for piece in pieces:
-            for action in tree.actions[piece - 1]:
-                state = tree.actions[piece - 1][action]
-                u = state.max_utility #- (times_filled[i] * 1000)
+            for action, u in tree_get_piece_actions(tree, piece - 1, rank):
+                #u = u - (times_filled[i] * 1000)
                 if best_utility == None or best_utility < u:
                     best_utility = u
                     best_action = (i, action)
@@ -226,26 +866,30 @@ def tree_get_best_action(trees, times_filled, pieces):
     # print best_utility
     return best_action
 
-def tree_get_solution(pieces, width, buffer_size, visualise):
-    b = board.Board(width)
+# pieces, solution and results are used in the same way as in get_solution
+# rank is given to tree_get_best_action.
+def tree_get_solution(pieces, width, buffer_size, visualise,
+                      board_class=board.BitBoard, solution=None,
+                      results=None, rank="max_utility"):
+    b = board_class(width)
     trees = load_trees(width)
+    if rank != "max_utility" and not all(hasattr(tree, rank)
+                                         for tree in trees):
+        raise ValueError("The trees have no {0}, run tools/expected.py on "
+                         "them and export them as .pdt files".format(rank))
     times_filled = [0, 0, 0] # stores how many times each tree has been replaced
-    buffer_size += 1
-    piece_buffer = []
-    if len(pieces) <= buffer_size:
-        piece_buffer = pieces
-        pieces = []
-    else:
-        piece_buffer = pieces[0:buffer_size]
-        pieces = pieces[buffer_size:len(pieces)]
-    solution = []
+    pieces = iter(pieces)
+    piece_buffer = collections.deque(itertools.islice(pieces,
+                                                      buffer_size + 1))
+    if solution is None:
+        solution = []
     # Each loop, the best action is found and applied, the used piece is removed
     # from piece_buffer, the next piece is placed, and the best action is
     # converted into a Move object and added to solution
     while piece_buffer:
         # print piece_buffer
         
-        a = tree_get_best_action(trees, times_filled, piece_buffer)
+        a = tree_get_best_action(trees, times_filled, piece_buffer, rank)
         if a == None:
             # print("Best action returned is none, adding more trees")
             for i in range(0, len(trees)):
@@ -286,6 +930,8 @@ def tree_get_solution(pieces, width, buffer_size, visualise):
         
         solution.append(m)
         b.apply_move(m)
+        if results is not None:
+            results.update(b)
         
         if visualise:
             print("grid after move:")
@@ -296,8 +942,7 @@ def tree_get_solution(pieces, width, buffer_size, visualise):
         
         #
         piece_buffer.remove(best_action.piece + 1)
-        if pieces:
-            piece_buffer.append(pieces.pop(0))
+        piece_buffer.extend(itertools.islice(pieces, 1))
         # if tree is complete, replace it with a fresh one
         for i in range(0, len(trees)):
             tree = trees[i]
@@ -420,6 +1065,9 @@ def tt():
     print(get_solution_max_height(s, 11))
     print_solution_board(s, 11)
     
+# Board engines selectable from the command line
+ENGINES = {"list": board.Board, "bit": board.BitBoard}
+
 def out_stats(file, input, width, buffersize, method, rows_cleared, final_height, num_holes):
     print
     print "STATS"
@@ -449,6 +1097,31 @@ if __name__ == "__main__":
                         default=1, help="The buffer size")
     parser.add_argument('--visualise', metavar='VISUALISE', type=bool,
                         default=False, help="Whether to visualise each move in the solution. Must be true or false")
+    parser.add_argument('--batched', action='store_true',
+                        help="Evaluate all candidate moves at once with NumPy")
+    parser.add_argument('--lookahead', metavar='DEPTH', type=int, default=1,
+                        help="Number of pieces in the buffer to look ahead over with a beam search, 1 is greedy")
+    parser.add_argument('--beam-width', metavar='BEAM-WIDTH', type=int,
+                        default=8, help="Number of boards kept at each ply of the lookahead")
+    parser.add_argument('--expectimax', metavar='DEPTH', type=int, default=0,
+                        help="Number of moves to look ahead over with expectimax, averaging over the pieces that could come next, 0 for none")
+    parser.add_argument('--piece-probabilities', metavar='P', type=float,
+                        nargs=7, default=None,
+                        help="Chance of each piece coming next for expectimax, estimated from the input if not given")
+    parser.add_argument('--time-limit', metavar='SECONDS', type=float,
+                        default=None, help="Time limit per move for expectimax")
+    parser.add_argument('--max-candidates', metavar='N', type=int,
+                        default=None, help="Number of moves searched below the first move by expectimax")
+    parser.add_argument('--processes', metavar='N', type=int, default=0,
+                        help="Number of worker processes to share the expectimax search between, 0 for none")
+    parser.add_argument('--tree-rank', metavar='RANK', default="max",
+                        choices=["max", "expected"],
+                        help="What method 2 ranks tree actions by, the max or the expected utility they lead to. expected is experimental and plays worse, see tools/expected.py")
+    parser.add_argument('--cache-size', metavar='CACHE-SIZE', type=int,
+                        default=0, help="Number of board utilities to cache for --expectimax, 0 for no cache")
+    parser.add_argument('--engine', metavar='ENGINE', default="bit",
+                        choices=sorted(ENGINES.keys()),
+                        help="Board engine to use, list or bit")
     parser.add_argument('--stats-out', metavar='STATS-OUT', default="stats.csv",
                         help="Output stats CSV file")
                         
@@ -458,27 +1131,64 @@ if __name__ == "__main__":
     final_height = 0
     num_holes = 0
     
+    # Boards rarely come up twice outside of expectimax, so the cache only
+    # costs time there, and worker processes would each be sent a copy of it
+    if args.cache_size > 0 and (args.expectimax < 2 or args.processes > 0):
+        parser.error("--cache-size can only be used with --expectimax, without --processes")
+    # Only the expectimax search is shared between processes
+    if args.processes > 0 and args.expectimax < 2:
+        parser.error("--processes can only be used with --expectimax")
+
     if args.method == 1:
+        move_function = get_best_move
+        if args.expectimax > 1 and args.processes > 0:
+            move_function = ParallelExpectimaxSearch(args.expectimax,
+                                                     args.piece_probabilities,
+                                                     args.time_limit,
+                                                     args.max_candidates,
+                                                     args.processes)
+        elif args.expectimax > 1:
+            move_function = ExpectimaxSearch(args.expectimax,
+                                             args.piece_probabilities,
+                                             args.time_limit,
+                                             args.max_candidates)
+        elif args.lookahead > 1:
+            move_function = BeamSearch(args.lookahead, args.beam_width)
+        elif args.batched:
+            move_function = get_best_move_batched
+        utility_function = utility.variable_alpha(-100, -80, 10, 3, 1)
+        if args.cache_size > 0:
+            utility_function = utility.CachedUtility(utility_function,
+                                                     args.cache_size)
         print "Getting pieces from {0}".format(args.input)
-        p = get_pieces_from_file(args.input)
-        print "Calculating solution"
-        b, s = get_solution(p, args.width,
-                         args.buffer_size,
-                         utility.variable_alpha(-100, -80, 10, 3, 1),
-                         args.visualise)
-        print "Writting solution to {0}".format(args.output)
-        write_solution_to_file(s, args.output)
+        p = iter_pieces_from_file(args.input)
+        print "Calculating solution, writing it to {0}".format(args.output)
+        try:
+            with SolutionWriter(args.output) as w:
+                b, s = get_solution(p, args.width,
+                                 args.buffer_size,
+                                 utility_function,
+                                 args.visualise, ENGINES[args.engine],
+                                 move_function, w)
+        finally:
+            if hasattr(move_function, "close"):
+                move_function.close()
+        if args.cache_size > 0:
+            cache = utility_function.cache
+            print "Utility cache: {0} hits, {1} misses, {2:.1%} hit rate".format(
+                cache.hits, cache.misses, cache.get_hit_rate())
         rows_cleared = b.get_rows_cleared()
         final_height = b.get_num_rows()
         num_holes = b.get_num_holes()
     elif args.method == 2:
         print "Getting pieces from {0}".format(args.input)
-        p = get_pieces_from_file(args.input)
-        print "Calculating solution"
-        b, s = tree_get_solution(p, args.width,
-                          args.buffer_size, args.visualise)
-        print "Writting solution to {0}".format(args.output)
-        write_solution_to_file(s, args.output)
+        p = iter_pieces_from_file(args.input)
+        print "Calculating solution, writing it to {0}".format(args.output)
+        with SolutionWriter(args.output) as w:
+            b, s = tree_get_solution(p, args.width,
+                              args.buffer_size, args.visualise,
+                              ENGINES[args.engine], w, None,
+                              args.tree_rank + "_utility")
         rows_cleared = b.get_rows_cleared()
         final_height = b.get_num_rows()
         num_holes = b.get_num_holes()
@@ -0,0 +1,315 @@
+# Flat, memory mappable decision tree files (.pdt).
+#
+# A pickled tree is a graph of State objects, which takes a long time to
+# unpickle and a lot of memory once loaded. A .pdt file holds the same tree
+# as a set of little-endian arrays, one entry per node or per action, which
+# are mapped into memory rather than read. Loading one is near instant, and
+# processes using the same file share its pages.
+#
+# The file starts with a header:
+#   magic 'PDT\0', version, height, width, number of nodes, number of sections
+# all as unsigned 32 bit ints, followed by a table of sections, each being
+#   name (8 bytes), offset (u64), count (u64), NumPy dtype (8 bytes)
+# The sections are:
+#   utility      f8[nodes]          utility of each node
+#   max_util     f8[nodes]          max_utility of each node
+#   board        u8[nodes]          board of each node as a bitmask, bit
+#                                   row * width + column, row 0 at the top
+#   offsets      u4[nodes * 7 + 1]  the actions of node n for piece p are
+#                                   offsets[n * 7 + p] up to
+#                                   offsets[n * 7 + p + 1]
+#   action       u4[actions]        each action, see encode_action
+#   child        u4[actions]        the node each action leads to
+#   best         i4[nodes * 7]      the action of node n for piece p with the
+#                                   highest max_utility of its child, the
+#                                   first if there are ties, or -1 if there
+#                                   are no actions
+# If the states have an expected_utility, see expected.py, there are also:
+#   expected     f8[nodes]          expected_utility of each node
+#   best_exp     i4[nodes * 7]      as best, by expected_utility
+# Nodes are numbered from the root, 0, outwards. Actions keep the order
+# they had in the tree they were exported from.
+#
+# Usage: python flattree.py tree4.p tree4.pdt
+
+import sys
+import mmap
+import struct
+import pickle
+import collections
+import numpy as np
+
+from tree import Action
+
+MAGIC = 'PDT\0'
+VERSION = 1
+NUM_PIECES = 7
+HEADER = struct.Struct('<4sIIIII')
+SECTION = struct.Struct('<8sQQ8s')
+
+# Packs an action into 32 bits
+def encode_action(a):
+  return a.piece | a.rotation << 3 | a.h << 5 | a.w << 13
+
+# Returns (piece, rotation, h, w) of an encoded action
+def decode_action(code):
+  return (code & 7, code >> 3 & 3, code >> 5 & 255, code >> 13 & 255)
+
+# Returns the board of a state as a bitmask
+def board_to_mask(board_state):
+  mask = 0
+  for i, e in enumerate(np.reshape(board_state, -1)):
+    if e:
+      mask |= 1 << i
+  return mask
+
+# Returns every state of the tree under root, root first, each only once.
+# States are told apart by id() so that a state reached by more than one
+# path is only stored once.
+def number_states(root):
+  states = [root]
+  index = {id(root): 0}
+  i = 0
+  while i < len(states):
+    for piece in range(NUM_PIECES):
+      for child in states[i].actions.get(piece, {}).itervalues():
+        if id(child) not in index:
+          index[id(child)] = len(states)
+          states.append(child)
+    i += 1
+  return states, index
+
+# Returns the best section for the given attribute of the states: the
+# position of the first action of each state for each piece whose child has
+# the highest value of it, or -1.
+def best_actions(states, offsets, children, attribute):
+  best = []
+  for i in range(len(offsets) - 1):
+    best_action = -1
+    best_value = None
+    for j in range(offsets[i], offsets[i + 1]):
+      value = getattr(states[children[j]], attribute)
+      if best_action < 0 or value > best_value:
+        best_action = j
+        best_value = value
+    best.append(best_action)
+  return np.array(best, '<i4')
+
+# Returns the sections of the file for the tree under root as an ordered
+# dict of name to NumPy array.
+def flatten_tree(root):
+  height = root.board._height
+  width = root.board._width
+  if height * width > 64:
+    raise ValueError, "Boards larger than 64 cells cannot be flattened"
+  states, index = number_states(root)
+  offsets = [0]
+  actions = []
+  children = []
+  for s in states:
+    for piece in range(NUM_PIECES):
+      for a, child in s.actions.get(piece, {}).iteritems():
+        actions.append(encode_action(a))
+        children.append(index[id(child)])
+      offsets.append(len(actions))
+  expected = hasattr(root, 'expected_utility')
+  sections = collections.OrderedDict()
+  sections['utility'] = np.array([s.utility for s in states], '<f8')
+  sections['max_util'] = np.array([s.max_utility for s in states], '<f8')
+  sections['board'] = np.array([board_to_mask(s._board_state) for s in states],
+                               '<u8')
+  sections['offsets'] = np.array(offsets, '<u4')
+  sections['action'] = np.array(actions, '<u4')
+  sections['child'] = np.array(children, '<u4')
+  sections['best'] = best_actions(states, offsets, children, 'max_utility')
+  if expected:
+    sections['expected'] = np.array([s.expected_utility for s in states],
+                                    '<f8')
+    sections['best_exp'] = best_actions(states, offsets, children,
+                                        'expected_utility')
+  return height, width, sections
+
+# Writes the sections of a tree to a .pdt file
+def write_sections(path, height, width, sections):
+  offset = HEADER.size + SECTION.size * len(sections)
+  table = []
+  for name, a in sections.iteritems():
+    if len(name) > 8:
+      raise ValueError, "Section names must be at most 8 characters"
+    offset += -offset % 8 # Keep every array aligned
+    table.append(SECTION.pack(name, offset, len(a), a.dtype.str))
+    offset += a.nbytes
+  with open(path, 'wb') as f:
+    f.write(HEADER.pack(MAGIC, VERSION, height, width,
+                        len(sections['utility']), len(sections)))
+    for entry in table:
+      f.write(entry)
+    for a in sections.itervalues():
+      f.write('\0' * (-f.tell() % 8))
+      f.write(a.tostring())
+
+# Writes the tree under root to a .pdt file
+def export_tree(root, path):
+  height, width, sections = flatten_tree(root)
+  write_sections(path, height, width, sections)
+
+# Stands in for tree.Board, as far as the tree method looks at it
+class FlatBoard(object):
+  def __init__(self, height, width):
+    self._height = height
+    self._width = width
+
+# A tree loaded from a .pdt file
+class FlatTree(object):
+  def __init__(self, path):
+    with open(path, 'rb') as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, height, width, self.num_nodes, num_sections = \
+      HEADER.unpack_from(self._map, 0)
+    if magic != MAGIC or version != VERSION:
+      raise ValueError, "Not a decision tree file: %s" % path
+    self.board = FlatBoard(height, width)
+    self.sections = {}
+    for i in range(num_sections):
+      name, offset, count, dtype = SECTION.unpack_from(
+        self._map, HEADER.size + i * SECTION.size)
+      self.sections[name.rstrip('\0')] = np.frombuffer(
+        self._map, dtype.rstrip('\0'), count, offset)
+    self.utility = self.sections['utility']
+    self.max_utility = self.sections['max_util']
+    self.boards = self.sections['board']
+    self.child_offsets = self.sections['offsets']
+    self.action_codes = self.sections['action']
+    self.children = self.sections['child']
+    self.best = self.sections['best']
+    self.expected_utility = self.sections.get('expected')
+    self.best_expected = self.sections.get('best_exp')
+    self._actions = {}
+
+  # Returns the Action of an encoded action, only making one per code
+  def get_action(self, code):
+    a = self._actions.get(code)
+    if a is None:
+      piece, rotation, h, w = decode_action(int(code))
+      a = Action(self.board, piece, rotation, h, w)
+      self._actions[code] = a
+    return a
+
+  def get_state(self, index):
+    return FlatState(self, index)
+
+  def get_root(self):
+    return FlatState(self, 0)
+
+# The actions of a FlatState for one piece, used like the dict of Action to
+# State in State.actions, iterating in the same order.
+class FlatActions(object):
+  def __init__(self, tree, first, last):
+    self._tree = tree
+    self._first = first
+    self._last = last
+
+  def __len__(self):
+    return self._last - self._first
+
+  def __iter__(self):
+    tree = self._tree
+    for i in range(self._first, self._last):
+      yield tree.get_action(tree.action_codes[i])
+
+  def keys(self):
+    return list(self)
+
+  def iteritems(self):
+    tree = self._tree
+    for i in range(self._first, self._last):
+      yield (tree.get_action(tree.action_codes[i]),
+             FlatState(tree, int(tree.children[i])))
+
+  def items(self):
+    return list(self.iteritems())
+
+  def __contains__(self, action):
+    return self.find(action) is not None
+
+  # Returns the position of the action in the action arrays, or None
+  def find(self, action):
+    code = encode_action(action)
+    for i in range(self._first, self._last):
+      if self._tree.action_codes[i] == code:
+        return i
+    return None
+
+  def __getitem__(self, action):
+    i = self.find(action)
+    if i is None:
+      raise KeyError(action)
+    return FlatState(self._tree, int(self._tree.children[i]))
+
+# The actions of a FlatState, by piece type
+class FlatActionTable(object):
+  def __init__(self, tree, index):
+    self._tree = tree
+    self._index = index
+
+  def __getitem__(self, piece):
+    i = self._index * NUM_PIECES + piece
+    offsets = self._tree.child_offsets
+    return FlatActions(self._tree, int(offsets[i]), int(offsets[i + 1]))
+
+# A node of a FlatTree, with the same attributes as State that the tree
+# method uses. utility can be changed, as it is on the root of each tree.
+class FlatState(object):
+  def __init__(self, tree, index):
+    self.tree = tree
+    self.index = index
+    self.board = tree.board
+    self.utility = float(tree.utility[index])
+    self.max_utility = float(tree.max_utility[index])
+    if tree.expected_utility is not None:
+      self.expected_utility = float(tree.expected_utility[index])
+    self.actions = FlatActionTable(tree, index)
+
+  def __repr__(self):
+    return "FS(%d, u:%.0f, mu:%.0f)" % (self.index, self.utility,
+                                        self.max_utility)
+
+  # Returns the action for the piece whose state has the highest
+  # max_utility, and that max_utility, or None if there are no actions.
+  # If there are ties, the first action is returned, as iterating over
+  # actions[piece] would find.
+  # If rank is 'expected_utility', the action with the highest
+  # expected_utility is returned instead.
+  def get_best_action(self, piece, rank='max_utility'):
+    tree = self.tree
+    if rank == 'expected_utility':
+      if tree.best_expected is None:
+        raise ValueError, "Tree has no expected utilities"
+      best, values = tree.best_expected, tree.expected_utility
+    else:
+      best, values = tree.best, tree.max_utility
+    i = best[self.index * NUM_PIECES + piece]
+    if i < 0:
+      return None
+    return (tree.get_action(tree.action_codes[i]),
+            float(values[tree.children[i]]))
+
+  @property
+  def _board_state(self):
+    mask = int(self.tree.boards[self.index])
+    size = self.board._height * self.board._width
+    cells = [bool(mask >> i & 1) for i in range(size)]
+    return np.array(cells).reshape(self.board._height, self.board._width)
+
+# Returns the root FlatState of a .pdt file
+def load_tree(path):
+  return FlatTree(path).get_root()
+
+if __name__ == "__main__":
+  if len(sys.argv) != 3:
+    print "Usage: python flattree.py TREE.p TREE.pdt"
+    sys.exit(1)
+  root = pickle.load(open(sys.argv[1], 'rb'))
+  export_tree(root, sys.argv[2])
+  states, _ = number_states(root)
+  print "Wrote %d nodes to '%s'." % (len(states), sys.argv[2])
@@ -0,0 +1,75 @@
+# Removes branches of a decision tree that the tree method can never take.
+#
+# solve.tree_get_best_action only takes an action if no action seen before
+# it has a higher max_utility. Whenever an action for a piece can be taken,
+# every other action for that piece from the same state can be too, so an
+# action whose max_utility is lower than that of another action for the
+# same piece from the same state is never taken, whatever is in the buffer.
+# Those actions, and any states only reachable through them, are removed.
+# Actions with the same max_utility as the best are all kept, so the order
+# ties are broken in does not change.
+# If the tree has expected utilities, see expected.py, actions can also be
+# ranked by them, so only actions that are lower by both are removed.
+#
+# Usage: python prune.py tree4.p tree4_pruned.p [--pdt tree4.pdt]
+
+import pickle
+import argparse
+
+import flattree
+
+# Removes the dominated actions of every state under root, in place.
+def prune_tree(root):
+  attributes = ['max_utility']
+  if hasattr(root, 'expected_utility'):
+    attributes.append('expected_utility')
+  states, _ = flattree.number_states(root)
+  for s in states:
+    for piece in s.actions.keys():
+      actions = s.actions[piece]
+      if not actions:
+        continue
+      best = [max(getattr(child, attribute) for child in actions.itervalues())
+              for attribute in attributes]
+      # Deleting from a dict keeps the order of the rest
+      for a in [a for a, child in actions.iteritems()
+                if all(getattr(child, attribute) < b
+                       for attribute, b in zip(attributes, best))]:
+        del actions[a]
+
+# Returns the number of states in the tree and the size of it pickled and
+# as a .pdt file, in bytes.
+def tree_size(root):
+  states, _ = flattree.number_states(root)
+  height, width, sections = flattree.flatten_tree(root)
+  flat = sum(a.nbytes for a in sections.itervalues())
+  return len(states), len(pickle.dumps(root)), flat
+
+# Prunes the tree under root and prints how much smaller it became
+def prune_and_report(root):
+  before = tree_size(root)
+  prune_tree(root)
+  after = tree_size(root)
+  print "Pruned %d of %d states." % (before[0] - after[0], before[0])
+  print "Pickled size %d -> %d bytes (%d saved)." % (before[1], after[1],
+                                                      before[1] - after[1])
+  print "Flat size %d -> %d bytes (%d saved)." % (before[2], after[2],
+                                                   before[2] - after[2])
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+    description='Removes branches of a decision tree that can never be taken'
+  )
+  parser.add_argument('tree', metavar='TREE', help='pickled tree to prune')
+  parser.add_argument('out', metavar='OUT', help='save pruned pickled tree')
+  parser.add_argument('--pdt', metavar='PDT', type=str,
+    help='also save the pruned tree as a .pdt file')
+  args = parser.parse_args()
+
+  root = pickle.load(open(args.tree, 'rb'))
+  prune_and_report(root)
+  pickle.dump(root, open(args.out, 'wb'))
+  print "Output saved to '%s'." % args.out
+  if args.pdt:
+    flattree.export_tree(root, args.pdt)
+    print "Output saved to '%s'." % args.pdt
@@ -0,0 +1,74 @@
+# Works out the utilities of a decision tree again with new weights, without
+# generating it again.
+#
+# The utility of every state is worked out from its board in one NumPy pass
+# over all of them, then max_utility is worked out again from the leaves up,
+# as create_tree does. The root keeps the utility it was given. If the
+# states have expected utilities they are worked out again too, see
+# expected.py.
+#
+# Actions removed by prune.py were only lower under the old weights, so a
+# tree should be rescored before it is pruned.
+#
+# Usage: python rescore.py tree4.p tree4_rescored.p --weights 1 3 10 -1000
+
+import pickle
+import argparse
+import numpy as np
+
+import flattree
+import expected
+
+NUM_PIECES = 7
+
+# Sets the weights of the board of the tree under root and works out the
+# utility and max_utility of every state under it again, in place.
+def rescore_tree(root, adjacent_block, adjacent_wall, adjacent_floor, hole):
+  states, _ = flattree.number_states(root)
+  board = root.board
+  board.set_weights(adjacent_block, adjacent_wall, adjacent_floor, hole)
+  utilities = board.batch_utility(np.array([s._board_state
+                                            for s in states[1:]]))
+  for s, u in zip(states[1:], utilities):
+    s.utility = float(u)
+  # Every state other than the root is the end of a valid permutation, so
+  # its max_utility includes its own utility. Children are numbered after
+  # their parents, so going backwards every child is done first.
+  for s in reversed(states):
+    if s is root:
+      s.max_utility = float('-inf')
+    else:
+      s.max_utility = s.utility
+    for piece in range(NUM_PIECES):
+      for c in s.actions.get(piece, {}).itervalues():
+        if c.max_utility > s.max_utility:
+          s.max_utility = c.max_utility
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(
+    description='Works out the utilities of a decision tree with new weights'
+  )
+  parser.add_argument('tree', metavar='TREE', help='pickled tree to rescore')
+  parser.add_argument('out', metavar='OUT', help='save rescored pickled tree')
+  parser.add_argument('--weights', metavar='W', type=float, nargs=4,
+    required=True,
+    help='utility of being adjacent to a block, a wall and the floor, and of a hole')
+  parser.add_argument('--pdt', metavar='PDT', type=str,
+    help='also save the rescored tree as a .pdt file')
+  parser.add_argument('--probabilities', metavar='P', type=float, nargs=7,
+    default=None, help='chance of each piece coming next, for expected utilities [default: equal]')
+  parser.add_argument('--full-utility', metavar='U', type=float,
+    default=expected.FULL_UTILITY,
+    help='utility used for a full board, for expected utilities [default: %d]' % expected.FULL_UTILITY)
+  args = parser.parse_args()
+
+  root = pickle.load(open(args.tree, 'rb'))
+  rescore_tree(root, *args.weights)
+  if hasattr(root, 'expected_utility'):
+    expected.annotate_expected(root, args.probabilities, args.full_utility)
+  print "Root max utility: %f" % root.max_utility
+  pickle.dump(root, open(args.out, 'wb'))
+  print "Output saved to '%s'." % args.out
+  if args.pdt:
+    flattree.export_tree(root, args.pdt)
+    print "Output saved to '%s'." % args.pdt
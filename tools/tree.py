@@ -8,10 +8,26 @@ class PieceNotFitError(ValueError):
   pass
   
 # Board represents a board with a given width and height  
+# The weights of the utility function can be given, the class attributes
+# are the defaults, which boards pickled before they could be given use.
 class Board(object):
-  def __init__(self, height, width):
+  UTILITY_ADJACENT_TO_BLOCK = 1
+  UTILITY_ADJACENT_TO_WALL = 3
+  UTILITY_ADJACENT_TO_FLOOR = 10
+  UTILITY_HOLE = -1000
+
+  def __init__(self, height, width, adjacent_block=UTILITY_ADJACENT_TO_BLOCK,
+               adjacent_wall=UTILITY_ADJACENT_TO_WALL,
+               adjacent_floor=UTILITY_ADJACENT_TO_FLOOR, hole=UTILITY_HOLE):
     self._width = width
     self._height = height
+    self.set_weights(adjacent_block, adjacent_wall, adjacent_floor, hole)
+
+  def set_weights(self, adjacent_block, adjacent_wall, adjacent_floor, hole):
+    self.UTILITY_ADJACENT_TO_BLOCK = adjacent_block
+    self.UTILITY_ADJACENT_TO_WALL = adjacent_wall
+    self.UTILITY_ADJACENT_TO_FLOOR = adjacent_floor
+    self.UTILITY_HOLE = hole
   
   #
   #   |
@@ -67,10 +83,10 @@ class Board(object):
     if np.all(board): # A filled board has infinite utility
       return float('inf')
   
-    UTILITY_ADJACENT_TO_BLOCK = 1
-    UTILITY_ADJACENT_TO_WALL = 3
-    UTILITY_ADJACENT_TO_FLOOR = 10
-    UTILITY_HOLE = -1000
+    UTILITY_ADJACENT_TO_BLOCK = self.UTILITY_ADJACENT_TO_BLOCK
+    UTILITY_ADJACENT_TO_WALL = self.UTILITY_ADJACENT_TO_WALL
+    UTILITY_ADJACENT_TO_FLOOR = self.UTILITY_ADJACENT_TO_FLOOR
+    UTILITY_HOLE = self.UTILITY_HOLE
 
     utility = 0
 
@@ -100,6 +116,28 @@ class Board(object):
 
     return utility
       
+  # Returns the utility of many boards at once, the same as utility gives
+  # for each. boards is a NumPy boolean array of shape (boards, height, width).
+  # As in utility, row 0 is the top, the "floor" is above row 0, and a hole
+  # is an empty cell with a block somewhere in a row after it.
+  def batch_utility(self, boards):
+    boards = np.asarray(boards, np.bool)
+    adjacent_block = 2 * ((boards[:, :, 1:] & boards[:, :, :-1]).sum(axis=(1, 2)) +
+                          (boards[:, 1:, :] & boards[:, :-1, :]).sum(axis=(1, 2)))
+    adjacent_wall = boards[:, :, 0].sum(axis=1) + boards[:, :, -1].sum(axis=1)
+    adjacent_floor = boards[:, 0, :].sum(axis=1)
+    # A cell has a block after it if any later row in its column does
+    after = np.logical_or.accumulate(boards[:, ::-1, :], axis=1)[:, ::-1, :]
+    after = np.concatenate((after[:, 1:, :],
+                            np.zeros_like(after[:, :1, :])), axis=1)
+    holes = (after & ~boards).sum(axis=(1, 2))
+    utility = (adjacent_block * self.UTILITY_ADJACENT_TO_BLOCK +
+               adjacent_wall * self.UTILITY_ADJACENT_TO_WALL +
+               adjacent_floor * self.UTILITY_ADJACENT_TO_FLOOR +
+               holes * self.UTILITY_HOLE).astype(np.float64)
+    utility[boards.all(axis=(1, 2))] = float('inf')
+    return utility
+
   # Returns a unique hash for each matrix' dimensions
   # Hash is only unique for matricies of the same dimension
   def matrix_hash(self, x):
@@ -11,9 +11,9 @@ import multiprocessing
 import time
 import hashlib
 from math import factorial
-from rect import Rect
 from tree import *
 from helper import *
+from prune import prune_and_report
 import pickle
 
 WIDTH = 4   # Default width
@@ -146,43 +146,34 @@ def hw_iterator():
   while True:
     yield (HEIGHT, WIDTH)
   
-# Check possibility
-def check_possibility(data):
-  global PIECES, HEIGHT, WIDTH
-  hw, cur_pieces = data
-  height, width = hw
-  HEIGHT = height
-  WIDTH = width
-
-  board = np.zeros((HEIGHT, WIDTH), np.bool)
-
-  indr = [] # List of coordinate pairs of all pieces
-  lowestc = [HEIGHT, WIDTH] # Lowest coordinate of all pieces: (bottom, left)
-  highestc = [0, 0] # Highest coordinate of all pieces: (top, right)
-  
-  boxcalc = False
-  prev_p = None
-  prev_bounding = None
-  for p in cur_pieces:
-    pheight = len(PIECES[p.piece])
-    pwidth = len(PIECES[p.piece][0])
-    coords = [[p.h, p.w], [pheight + p.h, pwidth + p.w]]
-    max_bounding = Rect(lowestc, highestc)
-    cur_bounding = Rect(*coords) # (bottom, left), (top, right)
-    
-    if prev_p is not None and prev_bounding is not None:
-      board = np.logical_or(prev_p.data, board)
-      indr.append(prev_bounding)
-    
-    prev_p = p
-    prev_bounding = cur_bounding
-    
-    # We couldn't work out if it collides or not cheaply, so now onto the hard stuff
-    if not possible(p.data, board):
-      return None # This seems to have improved performance by like 10000%, very suspicious, keep an eye on it
+# Returns whether every empty region of the grid could still be filled with
+# tetrominoes, given the bitmask of its filled cells (as from
+# Board.matrix_hash). A region is a set of empty cells joined side by side,
+# and can only be filled if it has a multiple of 4 cells.
+def fillable(filled, height, width):
+  full = (1 << (height * width)) - 1
+  # Bit n is in column width - 1 - n % width, so these are the bits that
+  # cannot move left or right within their row
+  left_edge = 0
+  right_edge = 0
+  for row in range(height):
+    left_edge |= 1 << (row * width + width - 1)
+    right_edge |= 1 << (row * width)
+  empty = full & ~filled
+  while empty:
+    region = empty & -empty
+    while True:
+      grown = (region | (region & ~left_edge) << 1 |
+               (region & ~right_edge) >> 1 |
+               region << width | region >> width) & empty
+      if grown == region:
+        break
+      region = grown
+    if bin(region).count("1") % 4 != 0:
+      return False
+    empty &= ~region
+  return True
 
-  return cur_pieces
- 
 # Input seconds, output H:MM:SS
 def time_output(s):
   hours, remainder = divmod(s, 3600)
@@ -191,34 +182,47 @@ def time_output(s):
  
 # We combine all existing combinations and rotations of pieces to see which
 # successfully fit together.
+# Each placement is a bitmask of the cells it fills, and combinations are
+# built up one placement at a time, depth first, in index order. A
+# combination is only built on while none of its placements overlap, so as
+# soon as two placements clash, no combination containing both is looked at.
+# The combinations are output largest first, then in index order, the order
+# itertools.combinations would give them in.
+# With --perfect, only combinations that fill the whole grid are output, and
+# a combination is not built on if it leaves an empty region that could not
+# be filled, see fillable.
 def calculate_possible(positions): 
   lp = len(positions)
 
   search_space = 0
-  iterables = []
   for i in range(PIECES_FIT):
     search_space = search_space + ( factorial(lp) / ( factorial(lp-(PIECES_FIT-i)) * factorial(PIECES_FIT-i) ) )
-    iterables.append(itertools.combinations(positions, PIECES_FIT-i))
   
   print "Calculating possible combinations of tetrominoes from all placements (%d combinations)." % search_space
   start_time = time.time()
   
+  masks = [BOARD.matrix_hash(p.data) for p in positions]
+  by_size = [[] for i in range(PIECES_FIT + 1)]
+  full = (1 << (HEIGHT * WIDTH)) - 1
+  
+  # Adds every combination made by adding placements from index start on
+  # to the placements chosen, which fill the cells filled
+  def extend(start, filled, chosen):
+    for i in range(start, lp):
+      if not masks[i] & filled:
+        combination = chosen + (i,)
+        now_filled = filled | masks[i]
+        if args.perfect and not fillable(now_filled, HEIGHT, WIDTH):
+          continue
+        if not args.perfect or now_filled == full:
+          by_size[len(combination)].append(combination)
+        if len(combination) < PIECES_FIT:
+          extend(i + 1, now_filled, combination)
+  extend(0, 0, ())
+  
   combinations = []
-  timer = time.time()
-  prev_i = 0
-
-  pool = multiprocessing.Pool() # Use multiple processes to leaverage maximum processing power
-  #for i, res in enumerate( itertools.imap(check_possibility, itertools.combinations(positions, PIECES_FIT)) ):
-  for i, res in enumerate( pool.imap_unordered(check_possibility, itertools.izip(hw_iterator(), itertools.chain(*iterables)), max(5, search_space/500)) ):
-    if res:
-      combinations.append(res)
-    elapsed = time.time() - timer
-    if elapsed > NOTIFY_INTERVAL and i != 0: # If x seconds have elapsed
-      pps = (i-prev_i)/elapsed
-      print "Searched %d/%d placements (%.1f%% complete, %.0f pieces/sec, ~%s remaining)" % (i, search_space, (i/float(search_space))*100, pps, time_output((search_space-i)/pps))
-      prev_i = i
-      timer = time.time()
-  pool.terminate()
+  for size in range(PIECES_FIT, 0, -1):
+    combinations.extend(tuple(positions[i] for i in c) for c in by_size[size])
     
   lc = len(combinations)   
   print "There are %d possible combinations of a maximum of %d tetrominoes within the %d positions." % (lc, PIECES_FIT, search_space)
@@ -229,26 +233,54 @@ def calculate_possible(positions):
     
   calculate_valid(combinations)
     
+# Returns the indexes of the pieces that would be valid to place next on
+# the Tetris grid "a", the same as valid() would for each.
+def valid_pieces(pieces, a):
+  hover = adjacent(a)
+  drop = overhang(a)
+  return [i for i, p in enumerate(pieces)
+          if np.any(np.logical_and(p.data, hover))
+          and not np.any(np.logical_and(p.data, drop))]
+
 # Check validity
+# With perfect, no order is returned from a board that has an empty cell
+# beneath a block, as pieces are dropped from above and could never fill it.
+# Returns every order the pieces of a combination can be validly placed in.
+# Whether a piece can be placed next only depends on the pieces already
+# placed, not the order they were placed in, so the orders are worked out
+# over subsets of the pieces: the orders that finish the combination from a
+# subset are worked out once, and shared by every order that reaches it.
 def check_validity(data):
   global HEIGHT, WIDTH
-  hw, pieces = data
+  hw, perfect, pieces = data
   height, width = hw
   HEIGHT = height
   WIDTH = width
   
-  board = np.zeros((HEIGHT, WIDTH), np.bool)
-  pos = True  
-  for p in pieces:
-    if valid(p.data, board):
-      board = np.logical_or(p.data, board)
-    else:
-      return None
-  if pos:
-    return pieces
+  n = len(pieces)
+  full = (1 << n) - 1
+  endings = {full: [()]} # Orders that finish the combination, by subset
+  
+  def get_endings(placed):
+    if placed not in endings:
+      board = np.zeros((HEIGHT, WIDTH), np.bool)
+      for i in range(n):
+        if placed >> i & 1:
+          board = np.logical_or(pieces[i].data, board)
+      orders = []
+      if perfect and np.any(overhang(board)):
+        endings[placed] = orders
+        return orders
+      for i in valid_pieces(pieces, board):
+        if not placed >> i & 1:
+          orders.extend((pieces[i],) + e for e in get_endings(placed | 1 << i))
+      endings[placed] = orders
+    return endings[placed]
+  
+  return get_endings(0)
    
-# We permute over all possible combinations and rotations of pieces to see which
-# are valid tetris plays.
+# We work out the orders every possible combination of pieces can be validly
+# placed in, the valid tetris plays.
 def calculate_valid(possibilities): 
   lp = len(possibilities)
   search_space = lp * factorial(PIECES_FIT)
@@ -259,25 +291,17 @@ def calculate_valid(possibilities):
   combinations = []
   timer = time.time()
   prev_i = 0
-  counter = 0
   pool = multiprocessing.Pool() # Use multiple processes to leaverage maximum processing power
-  for possibility in possibilities:
-    # We permute every combination to work out the orders in which it would be valid
-    #for i, res in enumerate( itertools.imap(check_validity, itertools.permutations(possibility, len(possibility))) ):
-    for i, res in enumerate( pool.imap_unordered(check_validity, itertools.izip(hw_iterator(), itertools.permutations(possibility, len(possibility))), max(5,search_space/20)) ):
-      if res:
-        combinations.append(res)
-      counter += 1
-            
-      elapsed = time.time() - timer
-      if elapsed > NOTIFY_INTERVAL and i != 0: # If x seconds have elapsed
-        pps = (i-prev_i)/elapsed
-        print "Searched %d/%d placements (%.1f%% complete, %.0f pieces/sec, ~%s remaining)" % (i, search_space, (i/float(search_space))*100, pps, time_output((search_space-i)/pps))
-        prev_i = i
-        timer = time.time()
-  pool.terminate()
+  for i, res in enumerate( pool.imap(check_validity, itertools.izip(hw_iterator(), itertools.repeat(args.perfect), possibilities), max(5, lp/500)) ):
+    combinations.extend(res)
     
-  print counter
+    elapsed = time.time() - timer
+    if elapsed > NOTIFY_INTERVAL and i != 0: # If x seconds have elapsed
+      pps = (i-prev_i)/elapsed
+      print "Searched %d/%d combinations (%.1f%% complete, %.0f combinations/sec, ~%s remaining)" % (i, lp, (i/float(lp))*100, pps, time_output((lp-i)/pps))
+      prev_i = i
+      timer = time.time()
+  pool.terminate()
     
   lc = len(combinations)   
   print "There are %d valid permutations of a maximum of %d tetrominoes within the %d possibilities." % (lc, PIECES_FIT, search_space)
@@ -301,6 +325,11 @@ def calculate_valid(possibilities):
   
 # Creates tree from sorted list of tuples of actions
 # "permutations" assumes a sorted list of permutations
+# States are interned by their board, so a board reached by placing pieces in
+# different orders is only one State, shared by every path to it (making the
+# tree a DAG). Whether a piece can be placed only depends on the board, so
+# every path to a board has the same actions from it.
+# A State's parent is the first state it was reached from.
 def create_tree(permutations):
   print "Converting %d permutations into decision tree." % len(permutations)
   
@@ -308,79 +337,53 @@ def create_tree(permutations):
   root = State(BOARD, None, np.zeros((HEIGHT,WIDTH), np.bool))
   root.utility = float('inf') # Utility of this action
   
-  # Terminal nodes are used to reverse traverse the tree to calculate the max_utility
-  term_nodes = []
+  states = {0: root} # Every state, by the bitmask of its board
+  masks = {} # Bitmask of the board of each placement, by id
+  terminal = set() # Bitmasks of the states that permutations end at
   
   print "Calculating utilities."
   for nodes in permutations:
-    actions = []
-    parents = []
-    children = []
     cur_parent = root
+    mask = 0
     board_state = np.zeros((HEIGHT,WIDTH), np.bool)
     for i, p in enumerate(nodes):
+      if id(p) not in masks:
+        masks[id(p)] = BOARD.matrix_hash(p.data)
+      mask |= masks[id(p)]
       board_state = np.logical_or(board_state, p.data)
       a = p.get_action()
-      actions.append(a)
       
-      if a not in cur_parent.actions[a.piece].keys(): # Make sure we don't override the state node
-        s = State(BOARD, cur_parent, board_state)
-        # print "%s{%s}.actions[%d][%s] = %s{%s}" % (cur_parent, hex(id(cur_parent)), a.piece, a, s, hex(id(s)))
+      if a not in cur_parent.actions[a.piece]: # Make sure we don't override the state node
+        s = states.get(mask)
+        if s is None:
+          s = State(BOARD, cur_parent, board_state)
+          states[mask] = s
         cur_parent.actions[a.piece][a] = s
         cur_parent = s
       else:
         cur_parent = cur_parent.actions[a.piece][a]
-   
-    # Get list of memory references when traversing downwards
-    cur_state = root
-    drilldown = []
-    for a in actions:
-      drilldown.append(id(cur_state))
-      cur_state = cur_state.actions[a.piece][a]
-    drilldown.append(id(cur_state))
-    drilldown.reverse()
-    
-    # Get list of memory references when traversing upwards
-    cur_state = cur_parent
-    i = 0
-    drillup = []
-    while cur_state.parent is not None and i <= PIECES_FIT:
-      drillup.append(id(cur_state))
-      cur_state = cur_state.parent
-      i += 1
-    drillup.append(id(cur_state))
     
-    # Sanity check to ensure that parent->children == children->parent
-    if not (drillup == drilldown):
-      print "Uh oh, something is wrong!"
-      print drilldown
-      print drillup
-      print
-    
-    # cur_parent is the terminal node (at least currently)
-    cur_parent.max_utility = cur_parent.utility # The maximum utility of a terminal node is itself
-    term_nodes.append(cur_parent)
+    terminal.add(mask)
 
-  # Reverse traverse the tree to calculate the max_utility
+  print "%d states in the tree." % len(states)
+  
+  # Every action adds 4 blocks, so the children of a state have more blocks
+  # than it does. Going through states by number of blocks, most first,
+  # every child has its max_utility before its parents look at it.
   print "Calculating max utilities."
-  for n in term_nodes:
-    i = 0
-    while n.parent is not None:
-      c = n
-      n = n.parent
-      
-      if c.max_utility > n.max_utility:
-        n.max_utility = c.max_utility
-        
-      i += 1
-      if i > PIECES_FIT:
-        break
-        print "We seem to be stuck in a loop, exiting"
-        
-    if n != root:
-      print "Something is very wrong. The final node isn't the parent."
+  for mask in sorted(states, key=lambda m: bin(m).count("1"), reverse=True):
+    n = states[mask]
+    if mask in terminal:
+      n.max_utility = n.utility # The maximum utility of a terminal node is itself
+    for actions in n.actions.values():
+      for c in actions.itervalues():
+        if c.max_utility > n.max_utility:
+          n.max_utility = c.max_utility
         
   print "Tree created."
+  if args.prune:
+    print "Pruning actions that can never be taken."
+    prune_and_report(root)
   if args.out_t:
     pickle.dump(root, open(args.out_t,'wb'))
     print "Output saved to '%s'." % args.out_t
@@ -402,6 +405,11 @@ if __name__ == "__main__":
   parser.add_argument('--height', metavar='HEIGHT', type=int,
     default=HEIGHT, help='height of Tetris grid')
 
+  parser.add_argument('--perfect', action='store_true',
+    help='only generate orders that fill the whole grid, skipping placements that leave cells that could never be filled')
+  parser.add_argument('--prune', action='store_true',
+    help='remove actions from the tree that can never be taken')
+
   pin = parser.add_mutually_exclusive_group()
   pin.add_argument('--in-p', metavar='IN_P', type=str,
     help='import possibilities and resume program')
@@ -1,5 +1,7 @@
 # This file contains the utility functions used by the program
 
+import numpy as np
+
 import board
 import move
 
@@ -10,37 +12,171 @@ def utility_function_a(board):
     UTILITY_ADJACENT_TO_FLOOR = 1
     UTILITY_HOLE = -80
 
-    utility = 0
+    terms = get_terms(board)
+    return (terms.rows * UTILITY_OF_ROW +
+            terms.holes * UTILITY_HOLE +
+            terms.adjacent_wall * UTILITY_ADJACENT_TO_WALL +
+            terms.adjacent_floor * UTILITY_ADJACENT_TO_FLOOR +
+            terms.adjacent_block * UTILITY_ADJACENT_TO_BLOCK)
 
-    for row in range(0, board.get_num_rows()):
-        utility += UTILITY_OF_ROW
-        for column in range(0, board.get_width()):
-            if board.block_at(row, column):
-                positions = ((row - 1, column),
-                             (row + 1, column),
-                             (row, column - 1),
-                             (row, column + 1))
-                for pos in positions:
-                    if board.is_wall(pos[1]):
-                        utility += UTILITY_ADJACENT_TO_WALL
-                    elif board.is_floor(pos[0]):
-                        utility += UTILITY_ADJACENT_TO_FLOOR
-                    elif board.block_at(pos[0], pos[1]):
-                        utility += UTILITY_ADJACENT_TO_BLOCK
-            else:
-                # check for holes
-                for i in range(row + 1, board.get_num_rows()):
-                    if board.block_at(i, column):
-                        utility += UTILITY_HOLE
-                        break;
-                    # end if
-                # end for i
-            # end if
-        # end for column
-    # end for row
-
-    return utility
+# Holds the counts that the utility of a board is made from, so that the
+# utility of a board after a move can be worked out from the counts of the
+# board before it, see get_terms_after.
+# rows: number of rows
+# holes: number of empty cells with a block somewhere above them
+# adjacent_wall: number of block sides touching a wall
+# adjacent_floor: number of blocks touching the floor
+# adjacent_block: number of block sides touching another block
+# heights: the skyline of the board
+# blocks: number of blocks
+class UtilityTerms:
+    def __init__(self, rows, holes, adjacent_wall, adjacent_floor,
+                 adjacent_block, heights, blocks):
+        self.rows = rows
+        self.holes = holes
+        self.adjacent_wall = adjacent_wall
+        self.adjacent_floor = adjacent_floor
+        self.adjacent_block = adjacent_block
+        self.heights = heights
+        self.blocks = blocks
+
+# Counts the utility terms of a board in one pass up its rows, working on
+# whole rows at a time as bitmasks.
+# A block touches the block to its left where the row and the row shifted
+# right by one overlap, and the block below it where the row and the row
+# below overlap. Each touching pair is two block sides.
+# Every empty cell below the top of its column is a hole, so the number of
+# holes is the sum of the column heights less the number of blocks.
+def get_terms(board):
+    width = board.get_width()
+    num_rows = board.get_num_rows()
+    left_wall = 1
+    right_wall = 1 << (width - 1)
+    blocks = 0
+    adjacent_wall = 0
+    adjacent_block = 0
+    below = 0
+    for row in range(0, num_rows):
+        mask = board.get_row_mask(row)
+        blocks += bin(mask).count("1")
+        if mask & left_wall:
+            adjacent_wall += 1
+        if mask & right_wall:
+            adjacent_wall += 1
+        adjacent_block += bin(mask & mask >> 1).count("1") + \
+                          bin(mask & below).count("1")
+        below = mask
+    adjacent_floor = bin(board.get_row_mask(0)).count("1")
+    heights = board.get_heights()
+    return UtilityTerms(num_rows, sum(heights) - blocks, adjacent_wall,
+                        adjacent_floor, 2 * adjacent_block, heights, blocks)
+
+# Works out the utility terms of a board after a move, given the board and
+# its terms before the move, the cells the move places and the rows it fills
+# (as returned by Board.get_placement).
+# Only the neighbours of the placed cells, the rows next to the filled rows
+# and the tops of the columns are looked at, rather than the whole board.
+def get_terms_after(board, terms, cells, full_lines):
+    width = board.get_width()
+    heights = list(terms.heights)
+    rows = terms.rows
+    blocks = terms.blocks + len(cells)
+    adjacent_wall = terms.adjacent_wall
+    adjacent_floor = terms.adjacent_floor
+    adjacent_block = terms.adjacent_block
+    placed = set(cells)
+    # Rows of the board after the piece is placed, before lines are removed
+    masks = {}
+    for cell in cells:
+        row, column = cell
+        masks[row] = masks.get(row, 0) | 1 << column
+        if column == 0:
+            adjacent_wall += 1
+        if column == width - 1:
+            adjacent_wall += 1
+        if row == 0:
+            adjacent_floor += 1
+        # Sides touching the board are new on both blocks, sides touching
+        # the rest of the piece are counted again from the other block
+        for position in ((row - 1, column), (row + 1, column),
+                         (row, column - 1), (row, column + 1)):
+            if position in placed:
+                adjacent_block += 1
+            elif position[0] >= 0 and 0 <= position[1] < width and \
+            board.block_at(position[0], position[1]):
+                adjacent_block += 2
+        if row >= heights[column]:
+            heights[column] = row + 1
+        if row >= rows:
+            rows = row + 1
+    if full_lines:
+        def row_mask(row):
+            return board.get_row_mask(row) | masks.get(row, 0)
+        n = len(full_lines)
+        rows -= n
+        blocks -= n * width
+        adjacent_wall -= 2 * n
+        # Each full line touches itself width - 1 times across
+        adjacent_block -= 2 * (width - 1) * n
+        # Each run of full lines is cut out, and the rows either side of it
+        # come together
+        top = rows + n
+        i = 0
+        while i < n:
+            j = i
+            while j + 1 < n and full_lines[j + 1] == full_lines[j] + 1:
+                j += 1
+            first = full_lines[i]
+            last = full_lines[j]
+            adjacent_block -= 2 * width * (last - first)
+            below = 0
+            above = 0
+            if first > 0:
+                below = row_mask(first - 1)
+                adjacent_block -= 2 * bin(below).count("1")
+            if last + 1 < top:
+                above = row_mask(last + 1)
+                adjacent_block -= 2 * bin(above).count("1")
+            adjacent_block += 2 * bin(below & above).count("1")
+            if first == 0:
+                adjacent_floor = bin(above).count("1")
+            i = j + 1
+        # Columns whose highest block was in a full line drop to the next
+        # block down
+        removed = set(full_lines)
+        for column in range(0, width):
+            row = heights[column] - 1
+            while row >= 0 and (row in removed or
+                                not row_mask(row) >> column & 1):
+                row -= 1
+            heights[column] = row + 1 - len([line for line in full_lines
+                                             if line < row])
+    return UtilityTerms(rows, sum(heights) - blocks, adjacent_wall,
+                        adjacent_floor, adjacent_block, heights, blocks)
 
+# Counts the utility terms of many boards at once with NumPy.
+# boards is a boolean array of shape (boards, rows, width), with row 0 at
+# the bottom like Board. Rows above the top of a board must be empty.
+# Returns arrays of the rows, holes and wall, floor and block adjacency of
+# each board, the same counts as get_terms.
+def get_batch_terms(boards):
+    # A cell is covered if it or any cell above it in its column has a block
+    covered = np.logical_or.accumulate(boards[:, ::-1, :], axis=1)[:, ::-1, :]
+    heights = covered.sum(axis=1)
+    rows = heights.max(axis=1)
+    holes = (covered & ~boards).sum(axis=(1, 2))
+    adjacent_wall = boards[:, :, 0].sum(axis=1) + boards[:, :, -1].sum(axis=1)
+    adjacent_floor = boards[:, 0, :].sum(axis=1)
+    adjacent_block = 2 * ((boards[:, :, 1:] & boards[:, :, :-1]).sum(axis=(1, 2)) +
+                          (boards[:, 1:, :] & boards[:, :-1, :]).sum(axis=(1, 2)))
+    return (rows, holes, adjacent_wall, adjacent_floor, adjacent_block)
+
+# Working the utility out from the terms adds the weights up in a different
+# order to scanning the board. Sums of integers come out the same in any
+# order, but sums of other weights do not, so the terms are only used if
+# every weight is a whole number (terms_exact). Otherwise boards are scanned
+# cell by cell, adding the weights in the original order, and get_best_move
+# and get_best_move_batched give whole boards to __call__.
 class variable_alpha:
     def __init__(self, u_row, u_hole, u_adj_wall, u_adj_floor, u_adj_block):
         self._UTILITY_OF_ROW = u_row
@@ -48,8 +184,30 @@ class variable_alpha:
         self._UTILITY_ADJACENT_TO_WALL = u_adj_wall
         self._UTILITY_ADJACENT_TO_FLOOR = u_adj_floor
         self._UTILITY_ADJACENT_TO_BLOCK = u_adj_block
+        self.terms_exact = all(float(w).is_integer()
+                               for w in self.get_weights())
+
+    def get_weights(self):
+        return (self._UTILITY_OF_ROW, self._UTILITY_HOLE,
+                self._UTILITY_ADJACENT_TO_WALL,
+                self._UTILITY_ADJACENT_TO_FLOOR,
+                self._UTILITY_ADJACENT_TO_BLOCK)
+
+    # Returns the utility of a board from its UtilityTerms
+    def evaluate_terms(self, terms):
+        return (terms.rows * self._UTILITY_OF_ROW +
+                terms.holes * self._UTILITY_HOLE +
+                terms.adjacent_wall * self._UTILITY_ADJACENT_TO_WALL +
+                terms.adjacent_floor * self._UTILITY_ADJACENT_TO_FLOOR +
+                terms.adjacent_block * self._UTILITY_ADJACENT_TO_BLOCK)
 
     def __call__(self, board):
+        if self.terms_exact:
+            return self.evaluate_terms(get_terms(board))
+        return self.scan(board)
+
+    # Works out the utility of a board by looking at every cell
+    def scan(self, board):
         utility = 0
         for row in range(0, board.get_num_rows()):
             utility += self._UTILITY_OF_ROW
@@ -73,6 +231,90 @@ class variable_alpha:
                             break;
         return utility
 
+    # Returns the utilities of many boards at once, given as a NumPy boolean
+    # array of shape (boards, rows, width), see get_batch_terms.
+    def evaluate_batch(self, boards):
+        rows, holes, adjacent_wall, adjacent_floor, adjacent_block = \
+            get_batch_terms(boards)
+        return (rows * self._UTILITY_OF_ROW +
+                holes * self._UTILITY_HOLE +
+                adjacent_wall * self._UTILITY_ADJACENT_TO_WALL +
+                adjacent_floor * self._UTILITY_ADJACENT_TO_FLOOR +
+                adjacent_block * self._UTILITY_ADJACENT_TO_BLOCK)
+
+# A cache holding at most max_size entries, dropping the least recently
+# used ones first.
+# Rather than keeping the entries in order of use, which costs more than
+# working out a utility again, entries are kept in two plain dicts: the
+# current one, and the one before it. Entries used from the old dict are
+# moved to the current one, and once the current dict holds max_size / 2
+# entries the old dict is dropped and the current one becomes the old one.
+# So entries used within the last max_size / 2 puts are always kept.
+# Keeps count of how many lookups were hits and misses, so that the size can
+# be chosen for a workload.
+class LRUCache:
+    def __init__(self, max_size):
+        self._generation_size = max(1, max_size / 2)
+        self._entries = {}
+        self._old_entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries) + len(self._old_entries)
+
+    # Returns the value stored for key, or None if it is not in the cache
+    def get(self, key):
+        value = self._entries.get(key)
+        if value is None:
+            value = self._old_entries.pop(key, None)
+            if value is None:
+                self.misses += 1
+                return None
+            self.put(key, value)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if len(self._entries) >= self._generation_size:
+            self._old_entries = self._entries
+            self._entries = {}
+        self._entries[key] = value
+
+    def get_hit_rate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+# Wraps a utility function so that boards already seen are not evaluated
+# again. Boards are looked up by their Zobrist hash, and a board and its
+# mirror image share an entry, as every utility term is the same for both.
+# Hashes do not say how wide a board is, so one CachedUtility should only be
+# used for boards of one width.
+# If the utility function can score boards from their terms, so can this,
+# and get_move_utilities looks each candidate up by the hash it would have
+# (see Board.get_canonical_hash_with) before working its terms out.
+class CachedUtility:
+    def __init__(self, utility_function, max_size=100000):
+        self._utility_function = utility_function
+        self.terms_exact = getattr(utility_function, "terms_exact", False)
+        self.cache = LRUCache(max_size)
+
+    def evaluate_terms(self, terms):
+        return self._utility_function.evaluate_terms(terms)
+
+    def evaluate_batch(self, boards):
+        return self._utility_function.evaluate_batch(boards)
+
+    def __call__(self, board):
+        key = board.get_canonical_hash()
+        u = self.cache.get(key)
+        if u is None:
+            u = self._utility_function(board)
+            self.cache.put(key, u)
+        return u
+
 def test():
     b = board.Board(11)
     